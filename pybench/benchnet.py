@@ -0,0 +1,85 @@
+import sys
+import time
+from StringIO import StringIO
+
+from pyutil.net import Topology, CompactTopology
+
+
+class Stream(object):
+    """A reader that cannot seek, served one char at a time."""
+    def __init__(self, string):
+        self.reader = StringIO(string)
+
+    def read(self, n=-1):
+        return self.reader.read(n)
+
+
+def records(nnodes, nracks=500, ndcs=4):
+    return [('/dc%s/r%s/n%s' % (i % ndcs, i % nracks, i),
+             '10.%s.%s.%s' % (i >> 16, (i >> 8) & 255, i & 255))
+            for i in range(nnodes)]
+
+
+def build(nnodes, nracks=500, ndcs=4):
+    topology = Topology()
+    topology.addnodes(records(nnodes, nracks, ndcs))
+    return topology
+
+
+def timeit(function, *args):
+    start = time.time()
+    result = function(*args)
+    return result, time.time() - start
+
+
+def bench_serialize(nnodes=100000):
+    topology, elapsed = timeit(build, nnodes)
+    print('%-24s %10.3f sec' % ('build %s nodes' % (nnodes), elapsed))
+    writer = StringIO()
+    elapsed = timeit(Topology.serialize, topology, writer)[1]
+    string = writer.getvalue()
+    print('%-24s %10.3f sec %10s bytes' % ('serialize', elapsed,
+                                           len(string)))
+    result, elapsed = timeit(Topology.deserialize, StringIO(string))
+    print('%-24s %10.3f sec' % ('deserialize', elapsed))
+    result, elapsed = timeit(Topology.deserialize, Stream(string))
+    print('%-24s %10.3f sec' % ('deserialize stream', elapsed))
+    writer = StringIO()
+    elapsed = timeit(Topology.serialize_binary, topology, writer)[1]
+    string = writer.getvalue()
+    print('%-24s %10.3f sec %10s bytes' % ('serialize binary', elapsed,
+                                           len(string)))
+    result, elapsed = timeit(Topology.deserialize_binary, StringIO(string))
+    print('%-24s %10.3f sec' % ('deserialize binary', elapsed))
+    compact, elapsed = timeit(CompactTopology.read, StringIO(string))
+    print('%-24s %10.3f sec' % ('read compact', elapsed))
+    elapsed = timeit(compact.to_topology)[1]
+    print('%-24s %10.3f sec' % ('compact to topology', elapsed))
+    result, elapsed = timeit(Topology.from_records, records(nnodes))
+    print('%-24s %10.3f sec' % ('from_records', elapsed))
+
+
+def bench_diff(nnodes=100000, nchanges=100):
+    old = build(nnodes)
+    new = build(nnodes)
+    elapsed = timeit(old.diff, new)[1]
+    print('%-24s %10.3f sec' % ('first diff', elapsed))
+    for i, (fullname, ip) in enumerate(records(nchanges)):
+        new.setip(new.find_by_ip(ip), 'changed%s' % (i))
+    diff, elapsed = timeit(old.diff, new)
+    print('%-24s %10.3f sec %10s changes' % ('diff', elapsed, len(diff)))
+    writer = StringIO()
+    elapsed = timeit(diff.serialize, diff, writer)[1]
+    print('%-24s %10.3f sec %10s bytes' % ('serialize diff', elapsed,
+                                           len(writer.getvalue())))
+    elapsed = timeit(old.apply, diff)[1]
+    print('%-24s %10.3f sec' % ('apply', elapsed))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        bench_serialize(int(sys.argv[1]))
+        bench_diff(int(sys.argv[1]))
+    else:
+        bench_serialize()
+        bench_diff()
@@ -0,0 +1,118 @@
+import logging
+import resource
+import sys
+import threading
+import time
+
+from pyutil.run import Pool, Task, OSCmd
+
+logging.basicConfig(level=logging.WARNING)
+
+class NoopTask(Task):
+    def run(self):
+        self.success = True
+
+
+class CpuTask(Task):
+    def __init__(self, n=2000):
+        super(CpuTask, self).__init__()
+        self.n = n
+
+    def run(self):
+        total = 0
+        for i in xrange(self.n):
+            total += i * i
+        self.success = True
+
+
+def throughput(nthreads, ntasks, stealing, batch):
+    """Return tasks per second to run ntasks no-op tasks."""
+    tasks = [NoopTask() for i in range(ntasks)]
+    start = time.time()
+    with Pool(nthreads, stealing=stealing) as pool:
+        for i in range(0, ntasks, batch):
+            pool.add_many(tasks[i : i + batch])
+        pool.wait()
+    return ntasks / (time.time() - start)
+
+
+def bench_stealing(ntasks=20000, threads=(1, 2, 4, 8, 16), batch=100):
+    print('%8s %14s %14s %14s' % ('threads', 'shared/add', 'shared/many',
+                                  'stealing/many'))
+    for nthreads in threads:
+        print('%8s %14.0f %14.0f %14.0f' % (
+            nthreads,
+            throughput(nthreads, ntasks, False, 1),
+            throughput(nthreads, ntasks, False, batch),
+            throughput(nthreads, ntasks, True, batch)))
+
+
+def rss():
+    """Current resident KB of this process."""
+    try:
+        with open('/proc/self/statm', 'r') as fh:
+            pages = int(fh.read().split()[1])
+        return pages * resource.getpagesize() / 1024
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def percentile(values, q):
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def measure(make, ntasks, nthreads, depth, batch=100):
+    """Run ntasks tasks from make() with at most depth of them queued.
+
+    Return tasks per second, the p50 and p99 dispatch latency (queued to
+    started) in ms, the peak number of threads and the RSS in KB.
+    """
+    tasks = [make() for i in range(ntasks)]
+    batch = min(batch, depth)
+    peak = 0
+    start = time.time()
+    with Pool(nthreads, qlen=depth, logtasks=False) as pool:
+        for i in range(0, ntasks, batch):
+            # blocks while the queue is full
+            pool.add_many(tasks[i : i + batch], block=True)
+            peak = max(peak, threading.active_count())
+        pool.wait()
+        elapsed = time.time() - start
+        peak = max(peak, threading.active_count())
+        kb = rss()
+    latency = [(task.t_start - task.t_queued) * 1000 for task in tasks]
+    return (ntasks / elapsed, percentile(latency, 0.5),
+            percentile(latency, 0.99), peak, kb)
+
+
+WORKLOADS = [
+    ('noop', NoopTask, 20000),
+    ('cpu', CpuTask, 5000),
+    ('true', lambda: OSCmd('/bin/true'), 200),
+    ('output', lambda: OSCmd('seq 20000'), 100),
+]
+
+
+def bench_pool(threads=(1, 4, 16), depths=(10, 1000), workloads=None):
+    print('%8s %8s %8s %12s %10s %10s %8s %10s' % (
+        'workload', 'threads', 'depth', 'tasks/sec', 'p50 ms', 'p99 ms',
+        'nthread', 'rss KB'))
+    for name, make, ntasks in WORKLOADS:
+        if (workloads is not None) and (name not in workloads):
+            continue
+        for nthreads in threads:
+            for depth in depths:
+                rate, p50, p99, peak, kb = measure(make, ntasks, nthreads,
+                                                   depth)
+                print('%8s %8s %8s %12.0f %10.3f %10.3f %8s %10s' % (
+                    name, nthreads, depth, rate, p50, p99, peak, kb))
+
+
+if __name__ == '__main__':
+    if (len(sys.argv) > 1) and (sys.argv[1] == 'stealing'):
+        bench_stealing()
+    else:
+        bench_pool(workloads=sys.argv[1:] or None)
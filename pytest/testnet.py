@@ -1,7 +1,9 @@
+import random
 import unittest
 from StringIO import StringIO
 
-from pyutil.net import Node, Topology
+from pyutil.net import Node, Topology, CompactTopology, Placement
+from pyutil import net
 
 class TestTopology(unittest.TestCase):
     def testNode(self):
@@ -56,6 +58,459 @@ class TestTopology(unittest.TestCase):
         writer = StringIO()
         Topology.serialize(topology, writer)
         self.assertEqual(string, writer.getvalue())
+        self.assertEqual('n3', topology.find_by_ip('110').name)
+        self.assertEqual('/dc/r1', topology.getnode('/dc//r1/').fullname())
+
+    def testIndex(self):
+        topology = Topology()
+        topology.addnodes([('/dc%s/R1/N%s' % (i % 2, i), '10.0.0.%s' % (i))
+                           for i in range(10)])
+        self.assertEqual(2, len(topology.find_all_by_name('R1')))
+        self.assertEqual(None, topology.find_by_name('R2'))
+        self.assertEqual(None, topology.find_by_ip('10.0.1.0'))
+        self.assertEqual(None, topology.getnode('/dc2'))
+        # a subtree built aside is indexed when attached
+        rack = Node('R2', None)
+        rack.addchild(Node('N10', '10.0.0.10'))
+        topology.getnode('/dc1').addchild(rack)
+        rack.addchild(Node('N11', '10.0.0.11'))
+        self.assertEqual(rack, topology.find_by_name('R2'))
+        self.assertEqual('/dc1/R2/N10',
+                         topology.find_by_ip('10.0.0.10').fullname())
+        self.assertEqual('10.0.0.11', topology.getnode('/dc1/R2/N11').ip)
+        self.assertEqual(rack.getchild('N11'), topology.find_by_name('N11'))
+        self.assertEqual(topology.root, topology.find_by_name(''))
+        self.assertEqual(7, len(topology.getleaves('/dc1')))
+
+    def testFindOrder(self):
+        def bfs(topology, match):
+            queue = [topology.root]
+            while len(queue) > 0:
+                node = queue.pop(0)
+                if match(node):
+                    return node
+                queue.extend(node.children)
+            return None
+        topology = Topology()
+        # repeated names and ips, deeper ones added first
+        topology.addnodes([('/b/x/y/n', '1'), ('/b/x/n', '2'), ('/a/y/n', '2'),
+                           ('/b/y', '1'), ('/a/y/m', '3'), ('/a/x', '3'),
+                           ('/c/x', '1')])
+        compact = CompactTopology.from_topology(topology)
+        records = [(node.fullname(), node.ip)
+                   for node in topology.fullnames.itervalues()
+                   if len(node.children) == 0]
+        for other in (topology, Topology.from_records(records),
+                      compact.to_topology()):
+            for name in ('x', 'y', 'n'):
+                node = bfs(other, lambda node: node.name == name)
+                self.assertEqual(node, other.find_by_name(name))
+            for ip in ('1', '2', '3'):
+                node = bfs(other, lambda node: node.ip == ip)
+                self.assertEqual(node, other.find_by_ip(ip))
+        # the compact arrays keep the children order
+        for name in ('x', 'y', 'n'):
+            self.assertEqual(topology.find_by_name(name).fullname(),
+                             compact.find_by_name(name).fullname())
+        for ip in ('1', '2', '3'):
+            self.assertEqual(topology.find_by_ip(ip).fullname(),
+                             compact.find_by_ip(ip).fullname())
+        self.assertEqual('/b/y', topology.find_by_ip('1').fullname())
+        self.assertEqual('/b/x', topology.find_by_name('x').fullname())
+        # the next one in breadth first order takes over
+        topology.removenode('/b/y')
+        self.assertEqual('/c/x', topology.find_by_ip('1').fullname())
+        topology.setip(topology.getnode('/c/x'), None)
+        self.assertEqual('/b/x/y/n', topology.find_by_ip('1').fullname())
+
+    def testCache(self):
+        topology = Topology()
+        topology.addnodes([('/dc/R%s/N%s' % (i / 4, i), str(i))
+                           for i in range(8)])
+        leaves = topology.getleaves('/dc/R1')
+        leaves.pop()
+        self.assertEqual(4, len(topology.getleaves('/dc/R1/')))
+        self.assertEqual(2, len(topology.getracks()))
+        topology.addnode('/dc/R2/N8', '8')
+        self.assertEqual(9, len(topology.getleaves()))
+        self.assertEqual(3, len(topology.getracks('/dc')))
+        self.assertEqual('/dc/R2/N8', topology.find_by_ip('8').fullname())
+        # a node moved under another parent gets its new full name
+        rack = Node('R3', None)
+        rack.addchild(Node('N9', '9'))
+        self.assertEqual('/R3/N9', rack.getchild('N9').fullname())
+        topology.getnode('/dc').addchild(rack)
+        self.assertEqual('/dc/R3/N9', topology.find_by_ip('9').fullname())
+        self.assertEqual(4, len(topology.getracks()))
+
+    def testDiff(self):
+        def records(topology):
+            return sorted([(node.fullname(), node.ip)
+                           for node in topology.getleaves()])
+        old = Topology()
+        old.addnodes([('/dc/R%s/N%s' % (i / 4, i), str(i))
+                      for i in range(16)])
+        new = Topology()
+        new.addnodes([('/dc/R%s/N%s' % (i / 4, i), str(i))
+                      for i in range(16)])
+        self.assertEqual(0, len(old.diff(new)))
+        new.removenode('/dc/R0')
+        new.removenode('/dc/R2/N9')
+        new.movenode('/dc/R2/N8', '/dc/R3')
+        new.movenode('/dc/R1', '/dc2')
+        new.setip(new.getnode('/dc/R3/N12'), '99')
+        new.addnode('/dc/R4/N16', '16')
+        diff = old.diff(new)
+        self.assertEqual('/dc/R0', diff.removed[0])
+        self.assertEqual(sorted([('/dc/R2/N8', '/dc/R3'),
+                                 ('/dc/R1', '/dc2')]), sorted(diff.moved))
+        self.assertEqual([('/dc/R3/N12', '99')], diff.ipchanged)
+        self.assertEqual(['/dc/R2/N9'], diff.removed[1:])
+        self.assertEqual([('/dc/R4', None), ('/dc/R4/N16', '16'),
+                          ('/dc2', None)], sorted(diff.added))
+        writer = StringIO()
+        diff.serialize(diff, writer)
+        diff = net.TopologyDiff.deserialize(StringIO(writer.getvalue()))
+        racks = old.getracks()
+        old.apply(diff)
+        self.assertEqual(records(new), records(old))
+        self.assertEqual(0, len(old.diff(new)))
+        self.assertEqual(None, old.find_by_ip('0'))
+        self.assertEqual(None, old.getnode('/dc/R0/N1'))
+        self.assertEqual('/dc2/R1/N4', old.find_by_ip('4').fullname())
+        self.assertEqual('/dc/R3/N12', old.find_by_ip('99').fullname())
+        self.assertEqual(None, old.find_by_ip('12'))
+        self.assertEqual(old.getnode('/dc/R3/N8'), old.find_by_name('N8'))
+        self.assertEqual(None, old.find_by_name('N0'))
+        self.assertEqual(4, len(racks))
+        self.assertEqual(4, len(old.getracks()))
+        self.assertEqual(4, len(old.getleaves('/dc2')))
+        self.assertEqual(2, old.getnhops(old.getnode('/dc/R3/N8'),
+                                         old.getnode('/dc/R3/N13')))
+        self.assertRaises(ValueError, old.movenode, '/dc', '/dc/R3')
+        # a missing parent inside the subtree is not created
+        self.assertRaises(ValueError, old.movenode, '/dc', '/dc/R3/new')
+        self.assertEqual(None, old.getnode('/dc/R3/new'))
+        self.assertRaises(ValueError, old.movenode, '/dc/R3', '/dc/R3')
+        # the new parent already has a child with the same name
+        old.addnode('/dc2/R3/N0', '100')
+        self.assertRaises(ValueError, old.movenode, '/dc/R3', '/dc2')
+        self.assertEqual(old.getnode('/dc/R3/N8'),
+                         old.getnode('/dc/R3').getchild('N8'))
+        self.assertEqual(1, len(old.getnode('/dc2/R3').children))
+        old.removenode('/dc2/R3')
+        # a removed subtree is no longer part of the topology
+        rack = old.removenode('/dc/R4')
+        self.assertEqual(None, rack.topology)
+        self.assertEqual('/R4/N16', rack.getchild('N16').fullname())
+
+    def testIpIndex(self):
+        topology = Topology()
+        topology.addnodes([('/dc/R%s/N%s' % (i / 4, i), '10.%s.0.%s' % (
+            i / 4, i)) for i in range(16)])
+        topology.addnode('/dc6/R6/N6', '2001:db8::6')
+        topology.addnode('/other', 'not an ip')
+        for fullname, cidr in [('/dc/R0', '10.0.0.0/16'),
+                               ('/dc/R1', '10.1.0.0/16'),
+                               ('/dc', '10.0.0.0/8'),
+                               ('/dc6', '2001:db8::/32')]:
+            topology.setip(topology.getnode(fullname), cidr)
+        self.assertEqual(topology.getnode('/dc/R1'),
+                         topology.find_by_prefix('10.1.0.0/16'))
+        self.assertEqual(topology.getnode('/dc/R1'),
+                         topology.find_by_prefix('10.1.200.1'))
+        self.assertEqual(topology.getnode('/dc/R1/N5'),
+                         topology.find_by_prefix('10.1.0.5'))
+        self.assertEqual(topology.getnode('/dc'),
+                         topology.find_by_prefix('10.2.0.0/16'))
+        self.assertEqual(topology.getnode('/dc'),
+                         topology.find_by_prefix('10.200.0.1'))
+        self.assertEqual(None, topology.find_by_prefix('11.0.0.1'))
+        self.assertEqual(None, topology.find_by_prefix('0.0.0.0/0'))
+        self.assertEqual(topology.getnode('/dc6/R6/N6'),
+                         topology.find_by_prefix('2001:db8:0::6'))
+        self.assertEqual(topology.getnode('/dc6'),
+                         topology.find_by_prefix('2001:db8::7'))
+        self.assertEqual(['N8', 'N9', 'N10', 'N11'],
+                         [node.name for node in
+                          topology.find_by_cidr('10.2.0.0/16')])
+        self.assertEqual(['R1', 'N4', 'N5', 'N6', 'N7'],
+                         [node.name for node in
+                          topology.find_by_cidr('10.1.0.0/16')])
+        self.assertEqual(21, len(topology.find_by_cidr('::/0')))
+        self.assertEqual(19, len(topology.find_by_cidr('10.0.0.0/8')))
+        self.assertRaises(net.IpIndex.AddressError,
+                          topology.find_by_cidr, '10.0.0.0/33')
+        self.assertRaises(net.IpIndex.AddressError,
+                          topology.find_by_prefix, '10.0.0')
+        # rebuilt after changes
+        topology.addnode('/dc/R1/N16', '10.1.0.16')
+        self.assertEqual('N16', topology.find_by_prefix('10.1.0.16').name)
+        topology.setip(topology.getnode('/dc/R1'), None)
+        self.assertEqual('dc', topology.find_by_prefix('10.1.0.17').name)
+        topology.removenode('/dc')
+        self.assertEqual(None, topology.find_by_prefix('10.1.0.16'))
+
+    def testSerialize(self):
+        topology = self.build()
+        writer = StringIO()
+        Topology.serialize(topology, writer)
+        string = writer.getvalue()
+        # the reader is left right after the topology
+        reader = StringIO(string + string + 'tail')
+        first = Topology.deserialize(reader)
+        second = Topology.deserialize(reader)
+        self.assertEqual('tail', reader.read())
+        for result in (first, second):
+            self.assertEqual(map(str, topology.getleaves()),
+                             map(str, result.getleaves()))
+            self.assertEqual(topology.find_by_ip('100').fullname(),
+                             result.find_by_ip('100').fullname())
+        class Stream(object):
+            def __init__(self, string):
+                self.reader = StringIO(string)
+            def read(self, n):
+                return self.reader.read(n)
+        result = Topology.deserialize(Stream(string))
+        self.assertEqual(len(topology.fullnames), len(result.fullnames))
+        with self.assertRaises(EOFError):
+            Topology.deserialize(StringIO(string[:-5]))
+        with self.assertRaises(Topology.EMarkError):
+            Topology.deserialize(StringIO(string[:-1] + ')'))
+        with self.assertRaises(Node.SMarkError):
+            Topology.deserialize(StringIO(string[:-3] + 'x$$}'))
+
+    def testBinary(self):
+        topology = self.build()
+        writer = StringIO()
+        Topology.serialize_binary(topology, writer)
+        reader = StringIO(writer.getvalue() + 'tail')
+        result = Topology.deserialize_binary(reader)
+        self.assertEqual('tail', reader.read())
+        self.assertEqual(map(str, topology.getleaves()),
+                         map(str, result.getleaves()))
+        self.assertEqual(sorted(topology.fullnames),
+                         sorted(result.fullnames))
+        # only parent, nameidx and ipidx are written, the rest is derived
+        topology.addnode('/dup/N0', topology.getleaves()[0].ip)
+        compact = CompactTopology.from_topology(topology)
+        string = compact.to_bytes()
+        result = CompactTopology.from_bytes(string)
+        for field in ('parent', 'nameidx', 'ipidx', 'depth', 'end',
+                      'firstchild', 'nextsibling'):
+            self.assertEqual(list(getattr(compact, field)),
+                             list(getattr(result, field)))
+        self.assertEqual(compact.ips, result.ips)
+        self.assertTrue(len(string) < 4 * 3 * len(compact) +
+                        len('\0'.join(compact.names + compact.ips)))
+        self.assertEqual(sorted([(name, node.ip) for name, node in
+                                 topology.fullnames.iteritems()]),
+                         sorted([(name, node.ip) for name, node in
+                                 result.to_topology().fullnames.iteritems()]))
+
+    def testFromRecords(self):
+        records = [('/dc/R%s/N%s' % (i % 3, i), str(i)) for i in range(30)]
+        records.append(('/dc/R0/N0', 'dup'))
+        records.append(('//dc/./R1/', 'rack'))
+        records.append(('/dc/R3/N30/', '30'))
+        topology = Topology.from_records(records)
+        expected = Topology()
+        expected.addnodes(records)
+        self.assertEqual(map(str, expected.getleaves()),
+                         map(str, topology.getleaves()))
+        self.assertEqual('0', topology.getnode('/dc/R0/N0').ip)
+        # the rack was made by an earlier record, as with addnode()
+        self.assertEqual(None, topology.find_by_ip('rack'))
+        self.assertEqual(['R0', 'R1', 'R2', 'R3'],
+                         [n.name for n in topology.getnode('/dc').children])
+        def nodes(topology):
+            return sorted([(node.fullname(), node.ip)
+                           for node in topology.fullnames.itervalues()])
+        for records in ([('/a/b', '1'), ('/a', '2')],
+                        [('/a', '2'), ('/a/b', '1')],
+                        [('/a/b/c', '1'), ('/a/d', '2'), ('/a/b', '3'),
+                         ('/e', '4'), ('/e/f', '5'), ('/a', '6')]):
+            expected = Topology()
+            expected.addnodes(records)
+            self.assertEqual(nodes(expected),
+                             nodes(Topology.from_records(records)))
+
+    def testCompact(self):
+        topology = self.build()
+        compact = CompactTopology.from_topology(topology)
+        self.assertEqual(len(topology.fullnames), len(compact))
+        for scope in (None, '/x1', '/x2/x0/'):
+            self.assertEqual(map(str, topology.getleaves(scope)),
+                             map(str, compact.getleaves(scope)))
+            self.assertEqual(map(str, topology.getracks(scope)),
+                             map(str, compact.getracks(scope)))
+        compact = CompactTopology.from_bytes(compact.to_bytes())
+        leaves = topology.getleaves()
+        cleaves = compact.getleaves()
+        for i in range(200):
+            a, b = random.randint(0, 199), random.randint(0, 199)
+            self.assertEqual(topology.getnhops(leaves[a], leaves[b]),
+                             compact.getnhops(cleaves[a], cleaves[b]))
+        node = compact.find_by_ip('7')
+        self.assertEqual(topology.find_by_ip('7').fullname(),
+                         node.fullname())
+        self.assertEqual(node, compact.getnode(node.fullname()))
+        self.assertEqual(node.name, node.parent.getchild(node.name).name)
+        self.assertEqual(topology.find_by_name('x3').fullname(),
+                         compact.find_by_name('x3').fullname())
+        self.assertEqual(None, compact.getnode('/x1/none'))
+        self.assertEqual(None, compact.root.ip)
+
+    def testPlacement(self):
+        # 2 dcs of 2 racks of 5 hosts
+        topology = Topology.from_records(
+            [('/dc%s/R%s/N%s' % (i / 10, i / 5, i), str(i))
+             for i in range(20)])
+        placement = Placement(topology)
+        for i in range(20):
+            hosts = placement.place(4)
+            self.assertEqual(4, len(set([h.parent for h in hosts])))
+        with self.assertRaises(Placement.NotEnough):
+            placement.place(5)
+        self.assertEqual(8, len(set(placement.place(8, maxpergroup=2))))
+        self.assertEqual(20, len(set(placement.place(20, spread=False))))
+        hosts = Placement(topology, level=1).place(2)
+        self.assertEqual(set(['dc0', 'dc1']),
+                         set([h.parent.parent.name for h in hosts]))
+        # excluded racks and hosts
+        rack = topology.getnode('/dc0/R0')
+        host = topology.find_by_ip('5')
+        for i in range(20):
+            hosts = placement.place(2, exclude=[rack, host])
+            self.assertFalse(rack in [h.parent for h in hosts])
+            self.assertFalse(host in hosts)
+        with self.assertRaises(Placement.NotEnough):
+            placement.place(4, exclude=[rack])
+        # the closest hosts first
+        near = topology.find_by_ip('7')
+        self.assertEqual([near], placement.place(1, near=near))
+        hosts = placement.place(2, near=near)
+        self.assertEqual([0, 4], [topology.getnhops(near, h) for h in hosts])
+        hosts = placement.place(5, near=near, exclude=[near], spread=False)
+        self.assertEqual([2, 2, 2, 2, 4],
+                         [topology.getnhops(near, h) for h in hosts])
+        # weights, and a rebuild on change
+        weight = lambda leaf: 0 if leaf.ip in ('0', '1', '2', '3') else 1
+        placement = Placement(topology, scope='/dc0', weight=weight)
+        for i in range(20):
+            hosts = placement.place(2)
+            self.assertFalse(set(['0', '1', '2', '3']) &
+                             set([h.ip for h in hosts]))
+        with self.assertRaises(Placement.NotEnough):
+            placement.place(3)
+        topology.addnode('/dc0/R9/N20', '20')
+        self.assertEqual(3, len(placement.place(3)))
+
+    def testPlacementIrregular(self):
+        # a rack with both hosts and a sub rack
+        topology = Topology()
+        topology.addnodes([('/dc/R1/N1', '1'), ('/dc/R1/X/N2', '2'),
+                           ('/dc/R1/N3', '3'), ('/dc/N4', '4')])
+        placement = Placement(topology)
+        for i in range(50):
+            hosts = placement.place(3)
+            self.assertEqual(3, len(set([h.parent for h in hosts])))
+        with self.assertRaises(Placement.NotEnough):
+            placement.place(4)
+        near = topology.find_by_ip('2')
+        hosts = placement.place(3, near=near, spread=False)
+        self.assertEqual(near, hosts[0])
+        self.assertEqual(set(['1', '3']), set([h.ip for h in hosts[1:]]))
+        hosts = placement.place(2, exclude=[topology.getnode('/dc/R1/X')])
+        self.assertFalse(near in hosts)
+        # by hops on leaves at several depths
+        topology = Topology()
+        topology.addnodes([('/dc/R1/N1', '1'), ('/dc/R1/X/Y/Z/N2', '2'),
+                           ('/dc/R2/N3', '3'), ('/dc/R2/N4', '4')])
+        placement = Placement(topology)
+        near = topology.find_by_ip('1')
+        for i in range(20):
+            hosts = placement.place(3, near=near, exclude=[near],
+                                    spread=False)
+            self.assertEqual([4, 4, 5],
+                             [topology.getnhops(near, h) for h in hosts])
+        hosts = placement.place(2, near=near, exclude=[near])
+        self.assertEqual([4, 5], [topology.getnhops(near, h) for h in hosts])
+        self.assertEqual(3, len(set([h.parent for h in placement.place(3)])))
+        self.assertEqual(4, len(set(placement.place(4, spread=False))))
+
+    def testNearest(self):
+        topology = self.build()
+        leaves = topology.getleaves()
+        for node in leaves[:20] + topology.find_all_by_name('x2')[:5]:
+            for scope in (None, '/x1', '/x1/x3'):
+                candidates = topology.getleaves(scope) if (
+                    topology.getnode(scope or '/') is not None) else []
+                hops = sorted(topology.getnhops(node, leaf)
+                              for leaf in candidates)
+                result = topology.nearest(node, 10, scope)
+                self.assertEqual(hops[:10], [topology.getnhops(node, leaf)
+                                             for leaf in result])
+                self.assertEqual(len(result), len(set(result)))
+                if node in candidates:
+                    self.assertEqual(node, result[0])
+        clients = leaves[:30]
+        for scope in (None, '/x0'):
+            batch = topology.nearest_many(clients, 5, scope)
+            for node, result in zip(clients, batch):
+                self.assertEqual(
+                    [topology.getnhops(node, leaf) for leaf in
+                     topology.nearest(node, 5, scope)],
+                    [topology.getnhops(node, leaf) for leaf in result])
+
+    def brute_nhops(self, node1, node2):
+        ancestors = []
+        curr = node1
+        while curr is not None:
+            ancestors.append(curr)
+            curr = curr.parent
+        dis2 = 0
+        curr = node2
+        while curr not in ancestors:
+            curr = curr.parent
+            dis2 += 1
+        return ancestors.index(curr) + dis2
+
+    def build(self):
+        topology = Topology()
+        random.seed(42)
+        for i in range(200):
+            path = ['x%s' % (random.randint(0, 3))
+                    for j in range(random.randint(1, 6))]
+            topology.addnode('/' + '/'.join(path) + '/n%s' % (i), str(i))
+        return topology
+
+    def testNhops(self):
+        topology = self.build()
+        nodes = topology.find_all_by_name('x1') + topology.getleaves()
+        for i in range(500):
+            node1, node2 = random.choice(nodes), random.choice(nodes)
+            self.assertEqual(self.brute_nhops(node1, node2),
+                             topology.getnhops(node1, node2))
+        # a change rebuilds the tables
+        leaf = topology.addnode('/x1/x2/x3/new', 'new')
+        node = topology.find_by_ip('7')
+        self.assertEqual(self.brute_nhops(leaf, node),
+                         topology.getnhops(leaf, node))
+        self.assertEqual(4, leaf.level())
+
+    @unittest.skipIf(net.numpy is None, 'numpy is not installed')
+    def testNhopsMatrix(self):
+        topology = self.build()
+        nodes1 = topology.getleaves()[:50] + [topology.root]
+        nodes2 = topology.getracks()
+        matrix = topology.nhops_matrix(nodes1, nodes2)
+        self.assertEqual((len(nodes1), len(nodes2)), matrix.shape)
+        for i, node1 in enumerate(nodes1):
+            for j, node2 in enumerate(nodes2):
+                self.assertEqual(self.brute_nhops(node1, node2),
+                                 matrix[i, j])
+
 
 if __name__ == '__main__':
     suite = unittest.TestSuite([
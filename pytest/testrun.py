@@ -1,11 +1,19 @@
+import json
 import logging
+import os
 import thread
 import time
 import unittest
 from threading import Thread
 
-from pyutil.run import Alarm, Pool, OSCmd, Task
+from pyutil.run import Alarm, Pool, OSCmd, Task, PriorityTaskQueue, TaskGraph
+from pyutil.run import TaskFuture, TaskListener, TaskStats, TaskTracer
+from pyutil.run import OSCmdBatch, ShellWorkerPool, FanOut, RetryPolicy
+from pyutil.run import Scheduler, TimeUtil, TaskJournal, ResourceLimits
+from pyutil.run import FuncTask
+from pyutil.net import Topology
 from pyutil.fio import StdFileWriter
+from StringIO import StringIO
 
 logging.basicConfig(level=logging.INFO)
 
@@ -21,6 +29,96 @@ class TestAlarm(unittest.TestCase):
         self.assertEqual(count[0], 5)
 
 
+class TestScheduler(unittest.TestCase):
+    def testMany(self):
+        counts = [0] * 200
+        def make(i):
+            def tick():
+                counts[i] += 1
+            return tick
+        scheduler = Scheduler()
+        for i in range(200):
+            scheduler.schedule(make(i), 0.1)
+        scheduler.start()
+        time.sleep(1.05)
+        scheduler.stop()
+        for count in counts:
+            self.assertTrue(count in (10, 11, 12))
+
+    def testDrift(self):
+        times = []
+        def slow():
+            times.append(TimeUtil.monotonic())
+            time.sleep(0.05)
+        scheduler = Scheduler()
+        timer = scheduler.schedule(slow, 0.1, at=0.1)
+        scheduler.start()
+        time.sleep(2.05)
+        scheduler.stop()
+        self.assertEqual(20, len(times))
+        self.assertAlmostEqual(1.9, times[-1] - times[0], delta = 0.02)
+        self.assertEqual(0, timer.noverruns)
+
+    def testOverrun(self):
+        fast = []
+        def slow():
+            time.sleep(0.25)
+        with Pool(2) as pool:
+            scheduler = Scheduler(pool)
+            inline = scheduler.schedule(slow, 0.1)
+            scheduler.start()
+            time.sleep(1.0)
+            scheduler.cancel(inline)
+            time.sleep(0.3)
+            self.assertTrue(inline.noverruns >= 5)
+            offloaded = scheduler.schedule(slow, 0.1, offload=True)
+            ticker = scheduler.schedule(lambda: fast.append(1), 0.1)
+            time.sleep(1.02)
+            scheduler.stop()
+            pool.wait()
+        self.assertTrue(len(fast) in (10, 11))
+        self.assertTrue(offloaded.noverruns >= 5)
+        # a run of 0.25 sec every 0.1 sec starts every third deadline
+        self.assertTrue(offloaded.nruns in (3, 4, 5))
+        self.assertTrue(offloaded.nruns + offloaded.noverruns in (10, 11))
+
+    def testAlarmSkip(self):
+        times = []
+        def slow():
+            times.append(TimeUtil.monotonic())
+            if len(times) == 1:
+                time.sleep(0.35)
+        alarm = Alarm(slow, 0.1)
+        alarm.start()
+        time.sleep(1.0)
+        alarm.stop()
+        # the deadlines missed by the slow run are skipped, no burst
+        self.assertTrue(len(times) in (7, 8))
+        gaps = [b - a for a, b in zip(times, times[1:])]
+        self.assertTrue(min(gaps) > 0.05)
+
+    def testClockFallback(self):
+        saved = TimeUtil._clock_gettime
+        try:
+            TimeUtil._clock_gettime = False
+            self.assertAlmostEqual(time.time(), TimeUtil.monotonic(),
+                                   delta = 0.1)
+        finally:
+            TimeUtil._clock_gettime = saved
+
+    def testOneShot(self):
+        calls = []
+        scheduler = Scheduler()
+        scheduler.start()
+        scheduler.call_later(lambda: calls.append('b'), 0.4)
+        scheduler.call_later(lambda: calls.append('a'), 0.2)
+        timer = scheduler.call_later(lambda: calls.append('c'), 0.3)
+        scheduler.cancel(timer)
+        time.sleep(0.6)
+        scheduler.stop()
+        self.assertEqual(['a', 'b'], calls)
+
+
 class KeyboardInterruptThread(Thread):
     def __init__(self, after=1):
         super(KeyboardInterruptThread, self).__init__()
@@ -46,7 +144,7 @@ class SleepTask(Task):
         else:
             self.logger.info('count=%s' % (self.count))
 
-    def kill(self):
+    def kill(self, force=False):
         self.logger.info('sleep task killed.')
         self.killed = True
 
@@ -72,6 +170,20 @@ class AddTask(Task):
         return 'add task'
 
 
+class RecordTask(Task):
+    def __init__(self, name, record, **kwargs):
+        super(RecordTask, self).__init__(**kwargs)
+        self.name = name
+        self.record = record
+
+    def run(self):
+        self.record.append(self.name)
+        self.success = True
+
+    def __str__(self):
+        return 'record task %s' % (self.name)
+
+
 class TestPool(unittest.TestCase):
     def testKeyboardInterrupt(self):
         after = 3
@@ -158,6 +270,562 @@ class TestPool(unittest.TestCase):
         self.assertEqual(33, len(ftasks))
 
 
+class TestPriority(unittest.TestCase):
+    def testPriority(self):
+        record = []
+        with Pool(1, queue=PriorityTaskQueue()) as pool:
+            pool.add(SleepTask(1))
+            time.sleep(0.2)
+            for i in range(5):
+                pool.add(RecordTask('batch%s' % (i), record, priority=10))
+            pool.add(RecordTask('urgent', record, priority=0))
+            pool.wait()
+        self.assertEqual('urgent', record[0])
+        self.assertEqual(['batch%s' % (i) for i in range(5)], record[1:])
+
+    def testAging(self):
+        record = []
+        with Pool(1, queue=PriorityTaskQueue(aging=10.0)) as pool:
+            pool.add(SleepTask(1))
+            time.sleep(0.2)
+            pool.add(RecordTask('old', record, priority=5))
+            time.sleep(0.6)
+            pool.add(RecordTask('new', record, priority=0))
+            pool.wait()
+        self.assertEqual(['old', 'new'], record)
+
+    def testDeadline(self):
+        record = []
+        with Pool(1, expire='fail') as pool:
+            pool.add(SleepTask(1))
+            pool.add(RecordTask('late', record, deadline=time.time() + 0.5))
+            pool.add(RecordTask('ok', record, deadline=time.time() + 5))
+            pool.wait()
+        self.assertEqual(['ok'], record)
+        self.assertEqual(1, pool.nexpired)
+        failed = pool.fetch_failed()
+        self.assertEqual(1, len(failed))
+        self.assertEqual('late', failed[0].name)
+        with Pool(1, expire='drop') as pool:
+            pool.add(SleepTask(1))
+            pool.add(RecordTask('late', record, deadline=time.time() + 0.5))
+            pool.wait()
+        self.assertEqual(1, pool.nexpired)
+        self.assertEqual(0, len(pool.fetch_failed()))
+
+
+class TestStealing(unittest.TestCase):
+    def testSteal(self):
+        start = time.time()
+        with Pool(2, stealing=True) as pool:
+            pool.add_many([SleepTask(3), SleepTask(1),
+                           SleepTask(1), SleepTask(1)])
+            pool.wait()
+        end = time.time()
+        self.assertAlmostEqual(3, end - start, delta = 0.5)
+        self.assertEqual(4, len(pool.fetch_succeeded()))
+
+    def testStress(self):
+        with Pool(4, stealing=True) as pool:
+            tasks = [AddTask(1, 2, i % 3 != 0) for i in range(99)]
+            pool.add_many(tasks[:50])
+            for task in tasks[50:]:
+                pool.add(task)
+            pool.wait()
+        self.assertEqual(0, pool.qlen())
+        self.assertEqual(66, len(pool.fetch_succeeded()))
+        self.assertEqual(33, len(pool.fetch_failed()))
+
+    def testFull(self):
+        with Pool(1, qlen=10) as pool:
+            pool.add(SleepTask(1))
+            time.sleep(0.2)
+            self.assertRaises(Pool.Full, pool.add_many,
+                              [SleepTask(0) for i in range(12)])
+            self.assertEqual(0, pool.qlen())
+
+
+class TestElastic(unittest.TestCase):
+    def testBound(self):
+        start = time.time()
+        with Pool(maxthreads=4) as pool:
+            for i in range(8):
+                pool.add(SleepTask(1))
+            self.assertEqual(4, len(pool.threads))
+            pool.wait()
+        end = time.time()
+        self.assertAlmostEqual(2, end - start, delta = 0.5)
+
+    def testIdle(self):
+        with Pool(minthreads=1, idletime=0.5) as pool:
+            pool.add_many([SleepTask(1) for i in range(5)])
+            self.assertEqual(5, len(pool.threads))
+            pool.wait()
+            time.sleep(2)
+            self.assertEqual(1, len(pool.threads))
+            pool.add(SleepTask(1))
+            pool.wait()
+        self.assertEqual(6, len(pool.fetch_succeeded()))
+
+    def testLatency(self):
+        start = time.time()
+        with Pool(latency=10) as pool:
+            pool.add(SleepTask(1))
+            pool.wait()
+            for i in range(4):
+                pool.add(SleepTask(1))
+            self.assertEqual(1, len(pool.threads))
+            pool.wait()
+        end = time.time()
+        self.assertAlmostEqual(5, end - start, delta = 0.5)
+
+
+class TestBackpressure(unittest.TestCase):
+    def testFull(self):
+        with Pool(1, qlen=2) as pool:
+            pool.add(SleepTask(1))
+            time.sleep(0.2)
+            pool.add(SleepTask(1))
+            pool.add(SleepTask(1))
+            self.assertRaises(Pool.Full, pool.add, SleepTask(1))
+            start = time.time()
+            self.assertRaises(Pool.Full, pool.add, SleepTask(1), True, 0.3)
+            self.assertAlmostEqual(0.3, time.time() - start, delta = 0.2)
+            pool.add(SleepTask(1), block=True)
+            self.assertAlmostEqual(1, time.time() - start, delta = 0.3)
+            self.assertRaises(ValueError, pool.add_many,
+                              [SleepTask(1) for i in range(3)], True)
+            pool.wait()
+        self.assertEqual(4, len(pool.fetch_succeeded()))
+
+    def testSubmit(self):
+        done = []
+        with Pool(2) as pool:
+            future = pool.submit(AddTask(1, 2, True))
+            failure = pool.submit(AddTask(1, 2, False))
+            slow = pool.submit(SleepTask(2))
+            self.assertEqual(2999, future.result(5).result)
+            self.assertRaises(TaskFuture.Failed, failure.result, 5)
+            self.assertRaises(TaskFuture.Timeout, slow.result, 0.1)
+            slow.add_done_callback(lambda f: done.append(f))
+            self.assertTrue(slow.result(5).success)
+            self.assertTrue(slow.done())
+            future.add_done_callback(lambda f: done.append(f))
+        self.assertEqual([slow, future], done)
+
+    def testFeed(self):
+        count = {'made' : 0, 'maxalive' : 0}
+        def tasks():
+            for i in range(200):
+                count['made'] += 1
+                alive = count['made'] - len(pool.succeeded)
+                count['maxalive'] = max(count['maxalive'], alive)
+                yield AddTask(1, 2, True)
+        with Pool(2, qlen=10) as pool:
+            pool.feed(tasks(), batch=5)
+            pool.wait()
+        self.assertEqual(200, len(pool.fetch_succeeded()))
+        self.assertTrue(count['maxalive'] <= 10 + 5 + 2)
+        # the default batch is larger than the queue
+        with Pool(2, qlen=3) as pool:
+            pool.feed(AddTask(1, 2, True) for i in range(50))
+            pool.wait()
+        self.assertEqual(50, len(pool.fetch_succeeded()))
+
+
+class EventListener(TaskListener):
+    def __init__(self):
+        self.events = []
+
+    def on_queued(self, task):
+        self.events.append(('queued', task))
+
+    def on_started(self, task):
+        self.events.append(('started', task))
+
+    def on_finished(self, task):
+        self.events.append(('finished', task))
+
+
+class CountHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.count = 0
+
+    def emit(self, record):
+        self.count += 1
+
+
+class TestInstrument(unittest.TestCase):
+    def testListener(self):
+        listener = EventListener()
+        stats = TaskStats()
+        tracer = TaskTracer()
+        with Pool(2) as pool:
+            pool.add_listener(listener)
+            pool.add_listener(stats)
+            pool.add_listener(tracer)
+            tasks = [AddTask(1, 2, i % 4 != 0) for i in range(20)]
+            pool.add_many(tasks)
+            pool.wait()
+        for task in tasks:
+            events = [e for e, t in listener.events if t is task]
+            self.assertEqual(['queued', 'started', 'finished'], events)
+            self.assertTrue(task.t_queued <= task.t_start <= task.t_end)
+        summary = stats.summary()
+        self.assertEqual(20, summary['finished'])
+        self.assertEqual(5, summary['failed'])
+        self.assertEqual(0.25, stats.failrate())
+        self.assertTrue(summary['wait_p99'] >= summary['wait_p50'] >= 0)
+        writer = StringIO()
+        tracer.dump(writer)
+        trace = json.loads(writer.getvalue())
+        self.assertEqual(20, len(trace['traceEvents']))
+        self.assertEqual('X', trace['traceEvents'][0]['ph'])
+
+    def testNoLog(self):
+        handler = CountHandler()
+        logger = logging.getLogger('TaskRunner')
+        logger.addHandler(handler)
+        try:
+            with Pool(2, logtasks=False) as pool:
+                pool.add_many([AddTask(1, 2, True) for i in range(10)])
+                pool.wait()
+            self.assertEqual(0, handler.count)
+            with Pool(2) as pool:
+                pool.add_many([AddTask(1, 2, True) for i in range(10)])
+                pool.wait()
+            self.assertEqual(10, handler.count)
+        finally:
+            logger.removeHandler(handler)
+
+
+class TestStream(unittest.TestCase):
+    def testAsCompleted(self):
+        with Pool(2) as pool:
+            pool.add(SleepTask(1))
+            pool.add(AddTask(1, 2, False))
+            time.sleep(0.2)
+            pool.add_many([SleepTask(2), AddTask(1, 2, True)])
+            tasks = list(pool.as_completed())
+        self.assertEqual(4, len(tasks))
+        ends = [task.t_end for task in tasks]
+        self.assertEqual(sorted(ends), ends)
+        self.assertEqual(0, len(pool.fetch_succeeded()))
+        self.assertEqual(0, len(pool.fetch_failed()))
+
+    def testBounded(self):
+        sizes = []
+        with Pool(4) as pool:
+            pool.add_many([AddTask(1, 2, True) for i in range(50)])
+            count = 0
+            for task in pool.as_completed(buflen=3):
+                sizes.append(len(pool.stream))
+                count += 1
+                time.sleep(0.01)
+                if count == 40:
+                    break
+            pool.wait()
+        self.assertTrue(max(sizes) <= 3)
+        self.assertEqual(10, len(pool.fetch_succeeded()))
+
+    def testTimeout(self):
+        with Pool(1) as pool:
+            pool.add(SleepTask(2))
+            start = time.time()
+            self.assertEqual([], list(pool.as_completed(timeout=0.5)))
+            self.assertAlmostEqual(0.5, time.time() - start, delta = 0.2)
+            pool.wait()
+        self.assertEqual(1, len(pool.fetch_succeeded()))
+
+    def testNoKeep(self):
+        with Pool(2, keepsucceeded=False) as pool:
+            pool.add_many([AddTask(1, 2, i % 2 == 0) for i in range(10)])
+            pool.wait()
+        self.assertEqual(0, len(pool.fetch_succeeded()))
+        self.assertEqual(5, len(pool.fetch_failed()))
+
+
+class FlakyTask(Task):
+    def __init__(self, nfailures, **kwargs):
+        super(FlakyTask, self).__init__(**kwargs)
+        self.nfailures = nfailures
+        self.starts = []
+
+    def run(self):
+        self.starts.append(time.time())
+        if len(self.starts) > self.nfailures:
+            self.success = True
+        else:
+            self.errmsg = 'failure %s' % (len(self.starts))
+
+
+class StragglerTask(Task):
+    def __init__(self, duration, copyduration=None):
+        super(StragglerTask, self).__init__()
+        self.duration = duration
+        self.copyduration = copyduration
+        self.killed = False
+
+    def run(self):
+        end = time.time() + self.duration
+        while (not self.killed) and (time.time() < end):
+            time.sleep(0.01)
+        self.success = not self.killed
+
+    def kill(self, force=False):
+        self.killed = True
+
+    def clone(self):
+        if self.copyduration is None:
+            return None
+        copy = StragglerTask(self.copyduration)
+        copy.taskid = self.taskid
+        copy.priority = self.priority
+        return copy
+
+
+class TestRetry(unittest.TestCase):
+    def testRetry(self):
+        policy = RetryPolicy(maxtries=3, backoff=0.2, factor=2.0)
+        with Pool(2) as pool:
+            ok = FlakyTask(2, retry=policy)
+            bad = FlakyTask(2, retry=RetryPolicy(maxtries=2, backoff=0.2))
+            pool.add_many([ok, bad])
+            pool.wait()
+        self.assertEqual([ok], pool.fetch_succeeded())
+        self.assertEqual([bad], pool.fetch_failed())
+        self.assertEqual(3, ok.ntries)
+        self.assertEqual(2, bad.ntries)
+        self.assertEqual('failure 2', bad.errmsg)
+        self.assertAlmostEqual(0.2, ok.starts[1] - ok.starts[0], delta = 0.1)
+        self.assertAlmostEqual(0.4, ok.starts[2] - ok.starts[1], delta = 0.1)
+
+    def testSpeculate(self):
+        start = time.time()
+        with Pool(4, speculate=0.9) as pool:
+            pool.add_many([StragglerTask(0.05) for i in range(20)])
+            pool.wait()
+            straggler = StragglerTask(10, 0.2)
+            pool.add(straggler)
+            pool.wait()
+        self.assertTrue(time.time() - start < 2)
+        succeeded = pool.fetch_succeeded()
+        self.assertEqual(21, len(succeeded))
+        self.assertTrue(straggler in succeeded)
+        self.assertTrue(straggler.success)
+        self.assertTrue(straggler.t_end - straggler.t_start < 1)
+        # the original keeps its own settings
+        self.assertEqual(10, straggler.duration)
+
+    def testSpeculateJournal(self):
+        path = '/tmp/testrun_speculate_%s' % (os.getpid())
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            journal = TaskJournal(path, syncinterval=0.1)
+            with Pool(4, speculate=0.9, journal=journal) as pool:
+                pool.add_many([StragglerTask(0.05) for i in range(20)])
+                pool.wait()
+                straggler = StragglerTask(10, 0.2)
+                straggler.taskid = 'straggler'
+                straggler.priority = 3
+                pool.add(straggler)
+                pool.wait()
+            journal.close()
+            self.assertTrue(straggler.success)
+            self.assertEqual('straggler', straggler.taskid)
+            self.assertEqual(3, straggler.priority)
+            journal = TaskJournal(path)
+            self.assertTrue(journal.succeeded('straggler'))
+            journal.close()
+            # only the results are adopted
+            task = OSCmd('true')
+            task.taskid = 'cmd'
+            copy = OSCmd('true')
+            copy.success = True
+            copy.retcode = 0
+            task.adopt(copy)
+            self.assertEqual(('cmd', True, 0),
+                             (task.taskid, task.success, task.retcode))
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+
+class StubbornTask(Task):
+    """Ignores the cooperative kill."""
+    def __init__(self, duration):
+        super(StubbornTask, self).__init__()
+        self.duration = duration
+        self.forced = False
+
+    def run(self):
+        end = time.time() + self.duration
+        while (not self.forced) and (time.time() < end):
+            time.sleep(0.01)
+
+    def kill(self, force=False):
+        self.forced = force
+
+
+class TestClose(unittest.TestCase):
+    def testCancel(self):
+        start = time.time()
+        pool = Pool(2)
+        pool.start()
+        sleeps = [SleepTask(100), SleepTask(100)]
+        pool.add_many(sleeps)
+        time.sleep(0.5)
+        queued = [AddTask(1, 2, True) for i in range(10)]
+        pool.add_many(queued[:9])
+        future = pool.submit(queued[9])
+        pool.close()
+        self.assertTrue(time.time() - start < 3)
+        self.assertFalse(any(t.is_alive() for t in pool.threads))
+        self.assertEqual(set(queued), set(pool.fetch_cancelled()))
+        self.assertEqual(set(sleeps), set(pool.fetch_failed()))
+        self.assertTrue(future.done())
+        with self.assertRaises(TaskFuture.Failed):
+            future.result()
+        late = AddTask(1, 2, True)
+        pool.add(late)
+        self.assertEqual([late], pool.fetch_cancelled())
+        pool.wait()
+
+    def testDrain(self):
+        start = time.time()
+        pool = Pool(2, stealing=True)
+        pool.start()
+        tasks = [SleepTask(1) for i in range(4)]
+        pool.add_many(tasks)
+        pool.close(drain=True)
+        self.assertAlmostEqual(2, time.time() - start, delta = 1)
+        self.assertEqual(set(tasks), set(pool.fetch_succeeded()))
+        self.assertEqual([], pool.fetch_cancelled())
+
+    def testEscalate(self):
+        stubborn = StubbornTask(100)
+        cmd = OSCmd('python -c "import signal, time; '
+                    'signal.signal(signal.SIGTERM, signal.SIG_IGN); '
+                    'time.sleep(100)"')
+        cmd.killgrace = 0.5
+        pool = Pool(2)
+        pool.start()
+        pool.add_many([stubborn, cmd])
+        time.sleep(0.5)
+        start = time.time()
+        pool.close(grace=0.2)
+        self.assertTrue(time.time() - start < 2)
+        self.assertTrue(stubborn.forced)
+        self.assertEqual(-9, cmd.retcode)
+        # a task that ignores both kills only holds close() up to timeout
+        pool = Pool(1)
+        pool.start()
+        stubborn = StubbornTask(100)
+        stubborn.kill = lambda force=False: None
+        pool.add(stubborn)
+        time.sleep(0.5)
+        start = time.time()
+        pool.close(timeout=1)
+        self.assertAlmostEqual(1, time.time() - start, delta = 0.5)
+        # and about 2 * grace without a timeout
+        pool = Pool(1)
+        pool.start()
+        stubborn = StubbornTask(100)
+        stubborn.kill = lambda force=False: None
+        pool.add(stubborn)
+        time.sleep(0.5)
+        start = time.time()
+        pool.close(grace=0.5)
+        self.assertAlmostEqual(1, time.time() - start, delta = 0.5)
+
+
+class TestTaskGraph(unittest.TestCase):
+    def testPipeline(self):
+        # two chains overlap instead of running in lockstep
+        start = time.time()
+        with Pool(2) as pool:
+            graph = TaskGraph(pool)
+            tasks = [SleepTask(1), SleepTask(2), SleepTask(2), SleepTask(1)]
+            graph.add(tasks[0])
+            graph.add(tasks[1])
+            graph.add(tasks[2], [tasks[0]])
+            graph.add(tasks[3], [tasks[1]])
+            graph.start()
+            self.assertTrue(graph.wait(10))
+        end = time.time()
+        self.assertAlmostEqual(3, end - start, delta = 0.5)
+        path = graph.critical_path()
+        self.assertTrue(path in ([tasks[0], tasks[2]], [tasks[1], tasks[3]]))
+
+    def testSkip(self):
+        record = []
+        with Pool(2) as pool:
+            graph = TaskGraph(pool)
+            ok = RecordTask('ok', record)
+            bad = AddTask(1, 2, False)
+            child = RecordTask('child', record)
+            grandchild = RecordTask('grandchild', record)
+            other = RecordTask('other', record)
+            graph.add(ok)
+            graph.add(bad)
+            graph.add(child, [ok, bad])
+            graph.add(grandchild, [child])
+            graph.add(other, [ok])
+            graph.start()
+            self.assertTrue(graph.wait(10))
+        self.assertEqual(['ok', 'other'], sorted(record))
+        self.assertEqual(set([child, grandchild]), set(graph.skipped))
+        self.assertFalse(grandchild.success)
+        with self.assertRaises(ValueError):
+            graph.add(RecordTask('orphan', record), [SleepTask(1)])
+
+
+class TestJournal(unittest.TestCase):
+    def setUp(self):
+        self.path = '/tmp/testrun_journal_%s' % (os.getpid())
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def testResume(self):
+        record = []
+        journal = TaskJournal(self.path, syncinterval=0.1)
+        with Pool(2, journal=journal) as pool:
+            tasks = [RecordTask(i, record, taskid=i) for i in range(10)]
+            tasks.append(AddTask(1, 2, False))
+            tasks[-1].taskid = 'bad'
+            pool.add_many(tasks)
+            pool.wait()
+        journal.close()
+        self.assertEqual(range(10), sorted(record))
+        # a crash tears the last record
+        with open(self.path, 'ab') as fh:
+            fh.write('T\x05\x00')
+        record = []
+        journal = TaskJournal(self.path, syncinterval=0.1)
+        self.assertEqual(None, journal.succeeded('bad'))
+        with Pool(2, journal=journal) as pool:
+            graph = TaskGraph(pool)
+            tasks = [RecordTask(i, record, taskid=i) for i in range(12)]
+            graph.add(tasks[0])
+            for task in tasks[1:]:
+                graph.add(task, [tasks[0]])
+            graph.start()
+            self.assertTrue(graph.wait(10))
+        journal.close()
+        self.assertEqual([10, 11], sorted(record))
+        self.assertEqual(10, pool.nresumed)
+        self.assertTrue(all(task.success for task in tasks))
+        journal = TaskJournal(self.path)
+        self.assertEqual(13, len(journal.records))
+        journal.close()
+
+
 class TestOSCmd(unittest.TestCase):
     def testRun(self):
         start = time.time()
@@ -243,10 +911,205 @@ class TestOSCmd(unittest.TestCase):
             self.assertEqual('Error', result)
 
 
+class TestResourceLimits(unittest.TestCase):
+    def testLimits(self):
+        base = os.nice(0)
+        # no cgroup v2 there, the memory limit falls back to RLIMIT_AS
+        limits = ResourceLimits(memory=200 << 20, nofile=64, nice=5,
+                                ioclass=3, cgroup='/nonexistent')
+        with Pool(2) as pool:
+            check = OSCmd('python -c "import os, resource; '
+                          'print os.nice(0), '
+                          'resource.getrlimit(resource.RLIMIT_NOFILE)[0]"',
+                          limits=limits)
+            hog = OSCmd('python -c "x = \'a\' * (400 << 20)"',
+                        limits=limits)
+            pool.add_many([check, hog])
+            pool.wait()
+        self.assertTrue(check.success)
+        self.assertEqual('%s 64' % (base + 5),
+                         check.writer.stdout().getvalue().strip())
+        self.assertFalse(hog.success)
+        self.assertTrue('MemoryError' in hog.writer.stderr().getvalue())
+
+    def testRusage(self):
+        with Pool(1) as pool:
+            cmd = OSCmd('python -c "x = \'a\' * (50 << 20); '
+                        'sum(xrange(3000000))"')
+            pool.add(cmd)
+            pool.wait()
+        self.assertEqual(0, cmd.retcode)
+        self.assertTrue(cmd.cputime > 0)
+        self.assertTrue(cmd.maxrss > 50 << 10)
+
+
+class TestOSCmdBatch(unittest.TestCase):
+    def testBatch(self):
+        cmds = ['echo out%s; echo err%s >&2' % (i, i) for i in range(100)]
+        cmds.append('cd /; exit 3')
+        cmds.append('pwd; printf tail')
+        with Pool(2) as pool:
+            pool.add(OSCmdBatch(cmds))
+            pool.wait()
+        task = pool.fetch_failed()[0]
+        self.assertEqual([0] * 100 + [3, 0], task.retcodes)
+        self.assertEqual('out7\n', task.writers[7].stdout().getvalue())
+        self.assertEqual('err7\n', task.writers[7].stderr().getvalue())
+        self.assertNotEqual('/\n',
+                            task.writers[101].stdout().getvalue()[:2])
+        self.assertTrue(
+            task.writers[101].stdout().getvalue().endswith('\ntail'))
+        self.assertTrue('exit with code 3' in task.errmsg)
+
+    def testWorkerPool(self):
+        workers = ShellWorkerPool(2)
+        try:
+            with Pool(2) as pool:
+                for i in range(6):
+                    pool.add(OSCmdBatch(['echo $$', 'true'], workers))
+                pool.add(OSCmdBatch(['sleep 10', 'echo $$'], workers,
+                                    timeout=1))
+                pool.wait()
+            pids = set([task.writers[0].stdout().getvalue()
+                        for task in pool.fetch_succeeded()])
+            self.assertTrue(len(pids) <= 2)
+            task = pool.fetch_failed()[0]
+            self.assertEqual([None, 0], task.retcodes)
+        finally:
+            workers.close()
+
+    def testSyntaxError(self):
+        cmds = ['echo )', "echo 'foo", 'echo after']
+        with Pool(1) as pool:
+            pool.add(OSCmdBatch(cmds, timeout=5))
+            pool.wait()
+        task = pool.fetch_failed()[0]
+        self.assertEqual(3, len(task.retcodes))
+        self.assertNotEqual(0, task.retcodes[0])
+        self.assertNotEqual(None, task.retcodes[1])
+        self.assertNotEqual(0, task.retcodes[1])
+        self.assertEqual('after\n', task.writers[2].stdout().getvalue())
+
+    def testReuseAfterError(self):
+        workers = ShellWorkerPool(1)
+        try:
+            with Pool(1) as pool:
+                # a line longer than the writer accepts raises in the batch
+                pool.add(OSCmdBatch(['head -c 200000 /dev/zero', 'true'],
+                                    workers))
+                pool.wait()
+                pool.add(OSCmdBatch(['echo second'], workers))
+                pool.wait()
+            self.assertEqual(1, len(pool.fetch_failed()))
+            task = pool.fetch_succeeded()[0]
+            self.assertEqual([0], task.retcodes)
+            self.assertEqual('second\n', task.writers[0].stdout().getvalue())
+        finally:
+            workers.close()
+
+
+class ConcurrencyTask(SleepTask):
+    def __init__(self, key, counts, peaks):
+        super(ConcurrencyTask, self).__init__(1)
+        self.key = key
+        self.counts = counts
+        self.peaks = peaks
+
+    def run(self):
+        for key in (self.key, 'total'):
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.peaks[key] = max(self.peaks.get(key, 0), self.counts[key])
+        super(ConcurrencyTask, self).run()
+        for key in (self.key, 'total'):
+            self.counts[key] -= 1
+
+
+class TestFanOut(unittest.TestCase):
+    def setUp(self):
+        self.topology = Topology()
+        self.topology.addnodes(
+            [('/dc/R%s/N%s' % (i / 4, i), '10.0.%s.%s' % (i / 4, i))
+             for i in range(12)])
+
+    def testLocal(self):
+        with Pool(4) as pool:
+            fanout = FanOut(pool, self.topology, 'echo %(ip)s %(name)s',
+                            maxperrack=2)
+            fanout.start('/dc')
+            self.assertTrue(fanout.wait(20))
+        self.assertEqual(12, len(fanout.tasks))
+        for leaf, task in fanout.tasks.iteritems():
+            self.assertTrue(task.success)
+            self.assertEqual('%s %s\n' % (leaf.ip, leaf.name),
+                             task.writer.stdout().getvalue())
+
+    def testLimits(self):
+        counts = {}
+        peaks = {}
+        def transport(node, cmd):
+            return ConcurrencyTask(node.parent.name, counts, peaks)
+        start = time.time()
+        with Pool(12) as pool:
+            fanout = FanOut(pool, self.topology, 'true', transport,
+                            maxperrack=2, maxtotal=5)
+            fanout.start()
+            self.assertTrue(fanout.wait(20))
+        self.assertAlmostEqual(3, time.time() - start, delta = 0.5)
+        self.assertEqual(5, peaks['total'])
+        for rack in ('R0', 'R1', 'R2'):
+            self.assertEqual(2, peaks[rack])
+
+    def testTimeout(self):
+        counts = {}
+        peaks = {}
+        def transport(node, cmd):
+            return ConcurrencyTask(node.parent.name, counts, peaks)
+        with Pool(4) as pool:
+            fanout = FanOut(pool, self.topology, 'true', transport,
+                            maxtotal=1)
+            fanout.start()
+            self.assertFalse(fanout.wait(0.5))
+            self.assertFalse(fanout in pool.listeners)
+            pool.wait()
+        self.assertEqual(1, len(pool.fetch_succeeded()))
+
+    def testFullQueue(self):
+        def transport(node, cmd):
+            return FuncTask(time.sleep, 0.01)
+        with Pool(1, qlen=1) as pool:
+            pool.add(SleepTask(1))
+            time.sleep(0.1)
+            pool.add(SleepTask(1))
+            fanout = FanOut(pool, self.topology, 'true', transport,
+                            maxperrack=4)
+            # nothing fits in the queue for now
+            fanout.start()
+            self.assertEqual(0, fanout.nrunning)
+            self.assertTrue(fanout.wait(20))
+            pool.wait()
+        for task in fanout.tasks.itervalues():
+            self.assertTrue(task.success)
+        self.assertEqual(0, fanout.nrunning)
+
+
 if __name__ == '__main__':
     suite = unittest.TestSuite([
         #unittest.TestLoader().loadTestsFromTestCase(TestAlarm),
+        unittest.TestLoader().loadTestsFromTestCase(TestScheduler),
         unittest.TestLoader().loadTestsFromTestCase(TestPool),
+        unittest.TestLoader().loadTestsFromTestCase(TestPriority),
+        unittest.TestLoader().loadTestsFromTestCase(TestStealing),
+        unittest.TestLoader().loadTestsFromTestCase(TestElastic),
+        unittest.TestLoader().loadTestsFromTestCase(TestBackpressure),
+        unittest.TestLoader().loadTestsFromTestCase(TestInstrument),
+        unittest.TestLoader().loadTestsFromTestCase(TestStream),
+        unittest.TestLoader().loadTestsFromTestCase(TestRetry),
+        unittest.TestLoader().loadTestsFromTestCase(TestClose),
+        unittest.TestLoader().loadTestsFromTestCase(TestTaskGraph),
+        unittest.TestLoader().loadTestsFromTestCase(TestJournal),
+        unittest.TestLoader().loadTestsFromTestCase(TestResourceLimits),
+        unittest.TestLoader().loadTestsFromTestCase(TestOSCmdBatch),
+        unittest.TestLoader().loadTestsFromTestCase(TestFanOut),
         #unittest.TestLoader().loadTestsFromTestCase(TestOSCmd),
     ])
     unittest.TextTestRunner().run(suite)
@@ -1,6 +1,7 @@
 import unittest
 
-from pyutil.stats import RollingStats, RandUtil, RandVar
+from pyutil.stats import RollingStats, RollingHist, RandUtil, RandVar
+from pyutil.stats import WeightTree
 
 class TestRollingStats(unittest.TestCase):
     def testRolling(self):
@@ -12,6 +13,26 @@ class TestRollingStats(unittest.TestCase):
         self.assertAlmostEqual(2.87, stats.std(), delta = 0.03)
 
 
+class TestRollingHist(unittest.TestCase):
+    def testHist(self):
+        hist = RollingHist(lo=1e-3, hi=1e3)
+        self.assertEqual(None, hist.percentile(0.5))
+        for i in range(1, 1001):
+            hist.update(i / 100.0)
+        self.assertAlmostEqual(5.005, hist.mean(), delta = 0.001)
+        self.assertAlmostEqual(5.0, hist.percentile(0.5), delta = 1.3)
+        self.assertAlmostEqual(9.9, hist.percentile(0.99), delta = 0.5)
+        self.assertEqual(10.0, hist.percentile(1.0))
+        self.assertEqual(0.01, hist.percentile(0.0))
+        self.assertTrue(hist.percentile(0.0001) >= 0.01)
+        hist.update(1e-6)
+        hist.update(1e6)
+        self.assertEqual(1e6, hist.percentile(1.0))
+        self.assertEqual(1e-6, hist.percentile(0.0))
+        hist.clear()
+        self.assertEqual(0, sum(hist.counts))
+
+
 class TestRandUtil(unittest.TestCase):
     def testPick(self):
         stats = RollingStats()
@@ -32,6 +53,30 @@ class TestRandUtil(unittest.TestCase):
         self.assertItemsEqual(map(lambda x : float(x) / 10, range(1, 11)), y)
 
 
+class TestWeightTree(unittest.TestCase):
+    def testTree(self):
+        weights = [1.0, 0.0, 2.0, 3.0, 0.0, 4.0]
+        tree = WeightTree(weights)
+        for i in range(len(weights) + 1):
+            self.assertEqual(sum(weights[:i]), tree.prefix(i))
+        self.assertEqual(0, tree.find(0.5))
+        self.assertEqual(2, tree.find(1.0))
+        self.assertEqual(5, tree.find(9.9))
+        counts = [0] * len(weights)
+        for i in range(6000):
+            counts[tree.pick(2, 6)] += 1
+        self.assertEqual(0, counts[0] + counts[1] + counts[4])
+        self.assertAlmostEqual(2000, counts[3], delta = 200)
+        tree.begin()
+        tree.add(3, -3.0)
+        tree.add(0, 5.0)
+        self.assertEqual(0.0, tree.range(3, 4))
+        self.assertEqual(2, tree.pick(2, 4))
+        tree.rollback()
+        for i in range(len(weights) + 1):
+            self.assertEqual(sum(weights[:i]), tree.prefix(i))
+
+
 class TestRandVar(unittest.TestCase):
     def testRandVar(self):
         v = RandVar.Exponential(1.0)
@@ -79,7 +124,9 @@ class TestRandVar(unittest.TestCase):
 if __name__ == '__main__':
     suite = unittest.TestSuite([
         unittest.TestLoader().loadTestsFromTestCase(TestRollingStats),
+        unittest.TestLoader().loadTestsFromTestCase(TestRollingHist),
         unittest.TestLoader().loadTestsFromTestCase(TestRandUtil),
+        unittest.TestLoader().loadTestsFromTestCase(TestWeightTree),
         unittest.TestLoader().loadTestsFromTestCase(TestRandVar),
     ])
     unittest.TextTestRunner().run(suite)
@@ -113,10 +113,10 @@ class StdPipeWriter(object):
         self.proc = proc
         self.std_writer = std_writer
         self.name = self.__class__.__name__
-        outthread = PipeThread(proc.stdout, std_writer.stdout())
-        errthread = PipeThread(proc.stderr, std_writer.stderr())
-        outthread.start()
-        errthread.start()
+        self.outthread = PipeThread(proc.stdout, std_writer.stdout())
+        self.errthread = PipeThread(proc.stderr, std_writer.stderr())
+        self.outthread.start()
+        self.errthread.start()
 
     def __str__(self):
         return '|'
@@ -128,6 +128,14 @@ class StdPipeWriter(object):
         return self.std_writer.stderr()
 
     def close(self):
+        # let the pipe threads drain what the process wrote before exiting,
+        # giving up only on a pipe that stays open with no output, e.g. held
+        # by an orphaned grandchild
+        for thread in (self.outthread, self.errthread):
+            nlines = -1
+            while thread.is_alive() and (thread.nlines != nlines):
+                nlines = thread.nlines
+                thread.join(1.0)
         self.std_writer.close()
         self.proc.stdout.close()
         self.proc.stderr.close()
@@ -138,7 +146,13 @@ class PipeThread(Thread):
         super(PipeThread, self).__init__()
         self.pipe = pipe
         self.writer = writer
+        self.nlines = 0
 
     def run(self):
         for line in iter(self.pipe.readline, ''):
-            self.writer.write(line)
+            try:
+                self.writer.write(line)
+            except ValueError:
+                # the writer was closed
+                break
+            self.nlines += 1
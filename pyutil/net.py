@@ -1,22 +1,56 @@
+import array
+import bisect
+import hashlib
+import itertools
+import re
+import socket
+import struct
+from collections import deque
+from itertools import izip
+from StringIO import StringIO
+from threading import Lock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from pyutil.serial import SerializeTool
+from pyutil.stats import WeightTree
 from pyutil.string import StringUtil
 
 class Node(object):
     class SMarkError(Exception):
         pass
 
+    # large topologies hold many nodes, keep them small
+    __slots__ = ('name', 'ip', 'parent', 'children', 'childmap', 'topology',
+                 'depth', 'fullpath', 'digest')
+
     def __init__(self, name, ip):
         self.name = name
         self.ip = ip
         self.parent = None
         self.children = []
+        self.childmap = {}
+        # the topology indexing this node, if any, and the level and full
+        # name cached by it
+        self.topology = None
+        self.depth = 0
+        self.fullpath = None
+        # digest of the subtree for Topology.diff(), None when changed
+        self.digest = None
 
     def fullname(self):
         """The full name of this node."""
+        if self.fullpath is not None:
+            return self.fullpath
         result = [self.name]
         curr = self.parent
         while curr is not None:
-            result.insert(0, curr.name)
+            result.append(curr.name)
             curr = curr.parent
+        result.reverse()
         result = '/'.join(result)
         if not result.startswith('/'):
             result = '/' + result
@@ -24,7 +58,51 @@ class Node(object):
 
     def addchild(self, node):
         self.children.append(node)
+        self.childmap.setdefault(node.name, node)
         node.parent = self
+        self.changed()
+        if self.topology is not None:
+            self.topology.index(node)
+
+    def removechild(self, node):
+        """Detach the child node and its subtree."""
+        self.children.remove(node)
+        if self.childmap.get(node.name) is node:
+            del self.childmap[node.name]
+            for child in self.children:
+                if child.name == node.name:
+                    self.childmap[node.name] = child
+                    break
+        node.parent = None
+        self.changed()
+        if self.topology is not None:
+            self.topology.unindex(node)
+
+    def changed(self):
+        """Drop the digests of this node and its ancestors."""
+        curr = self
+        while (curr is not None) and (curr.digest is not None):
+            curr.digest = None
+            curr = curr.parent
+
+    def getdigest(self):
+        """A digest of the names and ips of the subtree, children in any
+        order. Computed for the changed nodes only."""
+        if self.digest is not None:
+            return self.digest
+        stack = [(self, False)]
+        while len(stack) != 0:
+            curr, ready = stack.pop()
+            if not ready:
+                stack.append((curr, True))
+                stack.extend([(child, False) for child in curr.children
+                              if child.digest is None])
+                continue
+            md5 = hashlib.md5('%s\0%s\0' % (curr.name, curr.ip))
+            for digest in sorted([child.digest for child in curr.children]):
+                md5.update(digest)
+            curr.digest = md5.digest()
+        return self.digest
 
     def addchildren(self, nodes):
         for node in nodes:
@@ -32,10 +110,7 @@ class Node(object):
 
     def getchild(self, name):
         """Get the child by name."""
-        for child in self.children:
-            if child.name == name:
-                return child
-        return None
+        return self.childmap.get(name)
 
     def getnode(self, fullname):
         """Get node by full name."""
@@ -52,6 +127,8 @@ class Node(object):
 
     def level(self):
         """Current level of this node. The topmost level is 0."""
+        if self.topology is not None:
+            return self.depth
         count = -1
         curr = self
         while curr is not None:
@@ -107,6 +184,172 @@ class Topology(object):
 
     def __init__(self):
         self.root = Node('', None)
+        # ip -> nodes, name -> nodes and fullname -> node, maintained by
+        # Node.addchild() for the nodes under root
+        self.ips = {}
+        self.names = {}
+        self.fullnames = {}
+        # bumped on every change of the tree, to invalidate derived data
+        self.generation = 0
+        # Euler tour positions and sparse table for getnhops(), built
+        # lazily for a generation
+        self.lcagen = -1
+        self.first = None
+        self.sparse = None
+        self.npsparse = None
+        # sorted leaves and racks by scope for a generation
+        self.cachegen = -1
+        self.leaves = {}
+        self.racks = {}
+        # IpIndex of the node ips for a generation
+        self.ipgen = -1
+        self.ipindex = None
+        self.index(self.root)
+
+    def index(self, node):
+        """Index node and its subtree."""
+        self.generation += 1
+        node.fullpath = None
+        depth = 0 if node.parent is None else node.parent.level() + 1
+        stack = [(node, node.fullname(), depth)]
+        while len(stack) != 0:
+            curr, fullname, depth = stack.pop()
+            curr.topology = self
+            curr.depth = depth
+            curr.fullpath = fullname
+            self.fullnames.setdefault(fullname, curr)
+            self.names.setdefault(curr.name, []).append(curr)
+            if curr.ip is not None:
+                self.ips.setdefault(curr.ip, []).append(curr)
+            prefix = fullname if fullname.endswith('/') else fullname + '/'
+            for child in curr.children:
+                stack.append((child, prefix + child.name, depth + 1))
+
+    def unindex(self, node):
+        """Drop node and its subtree, just detached, from the indexes."""
+        self.generation += 1
+        stack = [node]
+        while len(stack) != 0:
+            curr = stack.pop()
+            if self.fullnames.get(curr.fullpath) is curr:
+                del self.fullnames[curr.fullpath]
+            nodes = self.names.get(curr.name)
+            if nodes is not None:
+                nodes.remove(curr)
+                if len(nodes) == 0:
+                    del self.names[curr.name]
+            if curr.ip is not None:
+                self.dropip(curr)
+            curr.topology = None
+            curr.fullpath = None
+            stack.extend(curr.children)
+
+    def setip(self, node, ip):
+        """Change the ip of a node, keeping the indexes."""
+        if node.ip is not None:
+            self.dropip(node)
+        node.ip = ip
+        if ip is not None:
+            self.ips.setdefault(ip, []).append(node)
+        node.changed()
+        self.generation += 1
+
+    def dropip(self, node):
+        """Drop node from the nodes of its ip."""
+        nodes = self.ips.get(node.ip)
+        if (nodes is not None) and (node in nodes):
+            nodes.remove(node)
+            if len(nodes) == 0:
+                del self.ips[node.ip]
+
+    def removenode(self, fullname):
+        """Remove the node and its subtree, return it or None."""
+        node = self.getnode(fullname)
+        if (node is None) or (node is self.root):
+            return None
+        node.parent.removechild(node)
+        return node
+
+    def movenode(self, fullname, parentname):
+        """Move the node and its subtree under another parent, created if
+        missing, and return it.
+
+        Raise ValueError, leaving the tree unchanged, if the parent is in
+        the subtree of the node or already has another child with the
+        same name."""
+        node = self.getnode(fullname)
+        if (node is None) or (node is self.root):
+            raise ValueError('No node to move: %s' % (fullname))
+        parentname = StringUtil.normalize_path(parentname)
+        prefix = node.fullname() + '/'
+        if (parentname + '/').startswith(prefix):
+            raise ValueError('Cannot move %s under itself.' % (fullname))
+        parent = self.getnode(parentname)
+        if parent is None:
+            parent = self.addnode(parentname, None)
+        elif parent.getchild(node.name) not in (None, node):
+            raise ValueError('Name collision moving %s under %s.'
+                             % (fullname, parentname))
+        node.parent.removechild(node)
+        parent.addchild(node)
+        return node
+
+    def diff(self, other):
+        """The TopologyDiff that turns this topology into other.
+
+        Subtrees with equal digests are skipped, so the cost follows the
+        number of changes. Children order is not compared.
+        """
+        result = TopologyDiff()
+        removed = []
+        added = []
+        stack = [(self.root, other.root)]
+        while len(stack) != 0:
+            mine, theirs = stack.pop()
+            if mine.getdigest() == theirs.getdigest():
+                continue
+            if (mine.ip != theirs.ip) and (mine is not self.root):
+                result.ipchanged.append((theirs.fullname(), theirs.ip))
+            for child in mine.children:
+                match = theirs.getchild(child.name)
+                if match is None:
+                    removed.append(child)
+                else:
+                    stack.append((child, match))
+            for child in theirs.children:
+                if mine.getchild(child.name) is None:
+                    added.append(child)
+        # a subtree removed in one place and added in another is moved
+        bydigest = {}
+        for node in removed:
+            bydigest.setdefault(node.getdigest(), []).append(node)
+        stack = list(reversed(added))
+        while len(stack) != 0:
+            curr = stack.pop()
+            sources = bydigest.get(curr.getdigest())
+            if sources:
+                result.moved.append((sources.pop().fullname(),
+                                     curr.parent.fullname()))
+                continue
+            result.added.append((curr.fullname(), curr.ip))
+            stack.extend(reversed(curr.children))
+        for nodes in bydigest.itervalues():
+            result.removed.extend([node.fullname() for node in nodes])
+        return result
+
+    def apply(self, diff):
+        """Update this topology in place with a TopologyDiff."""
+        for fullname, ip in diff.added:
+            self.addnode(fullname, ip)
+        for fullname, parentname in diff.moved:
+            self.movenode(fullname, parentname)
+        for fullname in diff.removed:
+            self.removenode(fullname)
+        for fullname, ip in diff.ipchanged:
+            node = self.getnode(fullname)
+            if node is None:
+                raise ValueError('No node to change: %s' % (fullname))
+            self.setip(node, ip)
 
     def addnode(self, fullname, ip):
         """Add a node."""
@@ -130,65 +373,168 @@ class Topology(object):
 
     def getleaves(self, scope=None):
         """Get all leaf node under scope."""
-        if scope is None:
-            node = self.root
-        else:
-            node = self.root.getnode(scope)
+        return list(self.cachedleaves(scope))
+
+    def getracks(self, scope=None):
+        """Get all racks under scope."""
+        scope = '/' if scope is None else StringUtil.normalize_path(scope)
+        leaves = self.cachedleaves(scope)
+        racks = self.racks.get(scope)
+        if racks is None:
+            racks = sorted(set([leaf.parent for leaf in leaves]), key=str)
+            self.racks[scope] = racks
+        return list(racks)
+
+    def cachedleaves(self, scope):
+        # the sorted leaves under scope, shared with the cache
+        scope = '/' if scope is None else StringUtil.normalize_path(scope)
+        if self.cachegen != self.generation:
+            self.leaves = {}
+            self.racks = {}
+            self.cachegen = self.generation
+        leaves = self.leaves.get(scope)
+        if leaves is not None:
+            return leaves
         leaves = []
-        queue = [node]
-        while len(queue) != 0:
-            curr = queue.pop(0)
+        stack = [self.getnode(scope)]
+        while len(stack) != 0:
+            curr = stack.pop()
             for child in curr.children:
                 if len(child.children) == 0:
                     leaves.append(child)
                 else:
-                    queue.append(child)
-        return sorted(leaves, key=str)
-
-    def getracks(self, scope=None):
-        """Get all racks under scope."""
-        racks = set([])
-        for leaf in self.getleaves(scope):
-            racks.add(leaf.parent)
-        return sorted(racks, key=str)
+                    stack.append(child)
+        leaves.sort(key=str)
+        self.leaves[scope] = leaves
+        return leaves
 
     def getnode(self, fullname):
         """Get the node by full name."""
-        return self.root.getnode(fullname)
+        return self.fullnames.get(StringUtil.normalize_path(fullname))
+
+    @classmethod
+    def bfskey(cls, node):
+        """The (depth, child positions from the root) of a node, which
+        sort the nodes in breadth first order."""
+        path = []
+        while node.parent is not None:
+            path.append(node.parent.children.index(node))
+            node = node.parent
+        path.reverse()
+        return (len(path), path)
+
+    @classmethod
+    def topmost(cls, nodes):
+        """The first of the nodes in breadth first order, or None."""
+        if not nodes:
+            return None
+        if len(nodes) == 1:
+            return nodes[0]
+        return min(nodes, key=cls.bfskey)
 
     def find_by_name(self, name):
-        """Search the node by its name."""
-        # bfs search
-        queue = [self.root]
-        while len(queue) > 0:
-            node = queue.pop(0)
-            if node.name == name:
-                return node
-            for child in node.children:
-                queue.append(child)
-        return None
+        """Search the node by its name, the first one in breadth first
+        order if several."""
+        return Topology.topmost(self.names.get(name))
+
+    def find_all_by_name(self, name):
+        """Get all the nodes with the name."""
+        return list(self.names.get(name, []))
 
     def find_by_ip(self, ip):
-        """Search the node by its ip."""
-        # bfs search
-        queue = [self.root]
-        while len(queue) > 0:
-            node = queue.pop(0)
-            if node.ip == ip:
-                return node
-            for child in node.children:
-                queue.append(child)
-        return None
+        """Search the node by its ip, the first one in breadth first order
+        if several."""
+        if ip is None:
+            return self.root
+        return Topology.topmost(self.ips.get(ip))
+
+    def getipindex(self):
+        """The IpIndex of the node ips, rebuilt after changes."""
+        if self.ipgen != self.generation:
+            self.ipindex = IpIndex(Topology.topmost(nodes)
+                                   for nodes in self.ips.itervalues())
+            self.ipgen = self.generation
+        return self.ipindex
+
+    def find_by_cidr(self, cidr):
+        """Search the nodes whose ip or network is within the cidr, like
+        '10.3.0.0/16', in address order."""
+        return self.getipindex().within(cidr)
+
+    def find_by_prefix(self, ip):
+        """Search the node with the longest network that holds the address
+        or cidr, an exact address first, or None."""
+        return self.getipindex().longest(ip)
+
+    def buildlca(self):
+        """Build the Euler tour of the tree, with the position of the first
+        visit of each node, and a sparse table of the min depth over the
+        tour ranges of length 2^j.
+
+        The common ancestor of two nodes is the shallowest node visited
+        between their first visits, so its depth is read from two table
+        entries.
+        """
+        if self.lcagen == self.generation:
+            return
+        generation = self.generation
+        depths = array.array('i', [0])
+        first = {self.root : 0}
+        stack = [[self.root, 0]]
+        while len(stack) != 0:
+            top = stack[-1]
+            node, i = top
+            if i < len(node.children):
+                top[1] += 1
+                child = node.children[i]
+                first[child] = len(depths)
+                depths.append(child.depth)
+                stack.append([child, 0])
+            else:
+                stack.pop()
+                if len(stack) != 0:
+                    depths.append(stack[-1][0].depth)
+        sparse = [depths]
+        half = 1
+        while 2 * half <= len(depths):
+            prev = sparse[-1]
+            sparse.append(array.array('i', [a if a < b else b for a, b in
+                                            izip(prev, prev[half:])]))
+            half *= 2
+        self.first = first
+        self.sparse = sparse
+        self.npsparse = None
+        self.lcagen = generation
+
+    def lcadepth(self, node1, node2):
+        """Depth of the lowest common ancestor of two nodes."""
+        lo = self.first[node1]
+        hi = self.first[node2]
+        if lo > hi:
+            lo, hi = hi, lo
+        k = (hi - lo + 1).bit_length() - 1
+        row = self.sparse[k]
+        a = row[lo]
+        b = row[hi - (1 << k) + 1]
+        return a if a < b else b
 
     def getnhops(self, node1, node2):
         if node1 is node2:
             return 0
+        if (node1.topology is self) and (node2.topology is self):
+            self.buildlca()
+            return (node1.depth + node2.depth -
+                    2 * self.lcadepth(node1, node2))
         dis = 0
-        while (node1 is not None) and (node1.level() > node2.level()):
+        level1 = node1.level()
+        level2 = node2.level()
+        while (node1 is not None) and (level1 > level2):
             node1 = node1.parent
+            level1 -= 1
             dis += 1
-        while (node2 is not None) and (node2.level() > node1.level()):
+        while (node2 is not None) and (level2 > level1):
             node2 = node2.parent
+            level2 -= 1
             dis += 1
         while ((node1 is not None) and (node2 is not None) and
                 (node1 is not node2)):
@@ -197,6 +543,101 @@ class Topology(object):
             dis += 2
         return dis
 
+    def nearest(self, node, n, scope=None):
+        """The n leaves under scope closest to node in hops, the closest
+        first.
+
+        A breadth first walk from node, up through its ancestors and down
+        into their other children, so the cost follows the number of nodes
+        within the distance of the n-th leaf, not the size of the tree.
+        Subtrees out of scope are skipped.
+        """
+        scope = self.scopename(scope)
+        result = []
+        queue = deque([(node, None)])
+        while (len(queue) != 0) and (len(result) < n):
+            curr, prev = queue.popleft()
+            if len(curr.children) == 0:
+                if self.inscope(curr, scope, True):
+                    result.append(curr)
+            for child in curr.children:
+                if (child is not prev) and self.inscope(child, scope):
+                    queue.append((child, curr))
+            parent = curr.parent
+            if (parent is not None) and (parent is not prev):
+                queue.append((parent, curr))
+        return result
+
+    def nearest_many(self, nodes, n, scope=None):
+        """nearest() for each of nodes, in a list.
+
+        The leaves of a rack share one walk from the rack: from a leaf,
+        the other leaves are one hop further than from its parent, in the
+        same order.
+        """
+        scope = self.scopename(scope)
+        byparent = {}
+        results = []
+        for node in nodes:
+            parent = node.parent
+            if (len(node.children) != 0) or (parent is None):
+                results.append(self.nearest(node, n, scope))
+                continue
+            if parent not in byparent:
+                byparent[parent] = self.nearest(parent, n + 1, scope)
+            result = [leaf for leaf in byparent[parent] if leaf is not node]
+            if self.inscope(node, scope, True):
+                result.insert(0, node)
+            results.append(result[:n])
+        return results
+
+    def scopename(self, scope):
+        if scope is None:
+            return None
+        scope = StringUtil.normalize_path(scope)
+        return None if scope == '/' else scope
+
+    def inscope(self, node, scope, within=False):
+        """Whether node is under scope, or on the path to it unless
+        within."""
+        if scope is None:
+            return True
+        fullname = node.fullname()
+        if (fullname == scope) or fullname.startswith(scope + '/'):
+            return True
+        return (not within) and ((fullname == '/') or
+                                 scope.startswith(fullname + '/'))
+
+    def nhops_matrix(self, nodes1, nodes2):
+        """Return a numpy array of the hops from each of nodes1 (rows) to
+        each of nodes2 (columns), all nodes of this topology.
+        """
+        if numpy is None:
+            raise ImportError('Topology.nhops_matrix requires numpy.')
+        self.buildlca()
+        if self.npsparse is None:
+            sparse = numpy.zeros((len(self.sparse), len(self.sparse[0])),
+                                 dtype=numpy.int32)
+            for j, row in enumerate(self.sparse):
+                sparse[j, :len(row)] = row
+            self.npsparse = sparse
+        first1 = numpy.array([self.first[n] for n in nodes1], dtype=numpy.intp)
+        first2 = numpy.array([self.first[n] for n in nodes2], dtype=numpy.intp)
+        depth1 = numpy.array([n.depth for n in nodes1], dtype=numpy.int32)
+        depth2 = numpy.array([n.depth for n in nodes2], dtype=numpy.int32)
+        lo = numpy.minimum.outer(first1, first2)
+        hi = numpy.maximum.outer(first1, first2)
+        k = numpy.zeros(lo.shape, dtype=numpy.intp)
+        span = hi - lo + 1
+        while True:
+            more = (span >> (k + 1)) > 0
+            if not more.any():
+                break
+            k += more
+        lca = numpy.minimum(self.npsparse[k, lo],
+                            self.npsparse[k, hi - (1 << k) + 1])
+        return depth1[:, None] + depth2[None, :] - 2 * lca
+
     @classmethod
     def serialize(cls, topology, writer, scope=None,
                   smark='{', emark='}', sep='$'):
@@ -207,39 +648,182 @@ class Topology(object):
             node = topology.root
         else:
             node = topology.getnode(scope)
-        pstack = []
-        curr = node
-        cvisited = False
-        writer.write(smark)
-        while (len(pstack) > 0) or (not cvisited):
-            if not cvisited:
-                if len(curr.children) > 0:
-                    pstack.append([curr, 0])
-                    Node.ensure_valid_ser(node, smark + emark + sep)
-                    Node.serialize(curr, writer)
-                    curr = curr.children[0]
-                else:
-                    cvisited = True
-                    Node.ensure_valid_ser(node, smark + emark + sep)
-                    Node.serialize(curr, writer)
-                    writer.write(sep)
-            else:
-                parent, idx = pstack[-1]
-                if idx != len(parent.children) - 1:
-                    idx += 1
-                    pstack[-1][1] = idx
-                    curr = parent.children[idx]
-                    cvisited = False
-                else:
-                    pstack.pop()
-                    curr = parent
-                    writer.write(sep)
-        writer.write(emark)
+        chars = smark + emark + sep + '(),'
+        # preorder, each node closed by sep after its children
+        parts = [smark]
+        stack = [(node, False)]
+        while len(stack) != 0:
+            curr, closing = stack.pop()
+            if closing:
+                parts.append(sep)
+                continue
+            Node.ensure_valid_ser(curr, chars)
+            parts.append('(%s,%s)' % (curr.name, curr.ip))
+            stack.append((curr, True))
+            for child in reversed(curr.children):
+                stack.append((child, False))
+        parts.append(emark)
+        writer.write(''.join(parts))
 
     @classmethod
     def deserialize(cls, reader, smark='{', emark='}', sep='$',
                     nsmark='(', nemark=')', nsep=','):
         # example: {(root, None)(ch1, None)$(ch2, None)$$}
+        # Parse the whole buffer with a regex, and seek the reader back to
+        # the end of the topology. Readers that cannot seek are read one
+        # char at a time.
+        try:
+            start = reader.tell()
+        except (AttributeError, IOError):
+            return cls.deserialize_stream(reader, smark, emark, sep,
+                                          nsmark, nemark, nsep)
+        data = reader.read()
+        topology, pos = cls.parse(data, smark, emark, sep,
+                                  nsmark, nemark, nsep)
+        reader.seek(start + pos)
+        return topology
+
+    @classmethod
+    def parse(cls, data, smark='{', emark='}', sep='$',
+              nsmark='(', nemark=')', nsep=','):
+        """Parse a serialized topology at the start of data.
+
+        Return the topology and the position after it.
+        """
+        if not data.startswith(smark):
+            raise Topology.SMarkError(data[:1])
+        # a node (name,ip) or a sep
+        stop = re.escape(nsep + nemark)
+        token = re.compile('%s([^%s]*)%s([^%s]*)%s|%s' % (
+            re.escape(nsmark), stop, re.escape(nsep), stop,
+            re.escape(nemark), re.escape(sep)))
+        pos = len(smark)
+        match = token.match(data, pos)
+        if (match is None) or (match.group(1) is None):
+            raise Node.SMarkError(data[pos : pos + 1])
+        name, ip = match.groups()
+        root = Node(name, None if ip == 'None' else ip)
+        if root.name is not '' and root.ip is not None:
+            raise ValueError('Incorrect root serialization.')
+        pos = match.end()
+        # the tree is built aside and attached to the topology at the end,
+        # to index each subtree once
+        holder = Node('', None)
+        stack = [holder]
+        while True:
+            match = token.match(data, pos)
+            if match is None:
+                if ((pos >= len(data)) or
+                        (data.startswith(nsmark, pos) and
+                         (data.find(nemark, pos) < 0))):
+                    raise EOFError('Unexpected EOF.')
+                raise Node.SMarkError(data[pos])
+            pos = match.end()
+            name, ip = match.groups()
+            if name is None:
+                stack.pop()
+                if len(stack) == 0:
+                    break
+            else:
+                node = Node(name, None if ip == 'None' else ip)
+                stack[-1].addchild(node)
+                stack.append(node)
+        if data[pos : pos + len(emark)] != emark:
+            raise Topology.EMarkError(data[pos : pos + 1])
+        topology = Topology()
+        topology.root.addchildren(holder.children)
+        return topology, pos + len(emark)
+
+    @classmethod
+    def serialize_binary(cls, topology, writer):
+        """Write the topology in the binary format of CompactTopology."""
+        CompactTopology.from_topology(topology).write(writer)
+
+    @classmethod
+    def deserialize_binary(cls, reader):
+        return CompactTopology.read(reader).to_topology()
+
+    @classmethod
+    def from_records(cls, records):
+        """Build a topology from (fullname, ip) records, as addnodes()
+        would, with the children in path order.
+
+        The records are sorted by path, so that each record shares the
+        nodes of its prefix with the previous one. The ips are the ones
+        addnode() would give in the order of the records: the ip goes to
+        the last node of the path, unless an earlier record already made
+        that node. The nodes are linked and indexed as they are made,
+        without addchild(). This is not faster than addnodes(): making the
+        nodes and the collector scanning them take most of the time.
+        """
+        keyed = []
+        for order, (fullname, ip) in enumerate(records):
+            parts = fullname.split('/')
+            if ((parts[0] != '') or ('' in parts[1:]) or ('.' in parts) or
+                    ('..' in parts)):
+                parts = StringUtil.normalize_path(fullname).split('/')
+                if parts[-1] == '':
+                    parts.pop()
+            keyed.append((parts[1:], order, ip))
+        keyed.sort(key=lambda record: record[0])
+        topology = Topology()
+        fullnames = topology.fullnames
+        names = topology.names
+        path = [topology.root]
+        # the full name of each node of path, '' for the root
+        prefixes = ['']
+        # the order of the record that gave its ip to each node of path,
+        # the sort being stable the first record of a path comes first
+        orders = [None]
+        nodes = []
+        prev = []
+        for parts, order, ip in keyed:
+            k = 0
+            n = min(len(prev), len(parts))
+            while (k < n) and (prev[k] == parts[k]):
+                k += 1
+            prev = parts
+            if k == len(parts):
+                # the same path again
+                continue
+            # an ancestor made by an earlier record has no ip
+            for i in range(1, k + 1):
+                if (orders[i] is not None) and (orders[i] > order):
+                    path[i].ip = None
+                    orders[i] = None
+            # later paths sort after, so the rest of the path is new
+            del path[k + 1:]
+            del prefixes[k + 1:]
+            del orders[k + 1:]
+            for name in parts[k:]:
+                parent = path[-1]
+                node = Node(name, None)
+                node.parent = parent
+                parent.children.append(node)
+                parent.childmap[name] = node
+                fullname = prefixes[-1] + '/' + name
+                node.topology = topology
+                node.depth = len(path)
+                node.fullpath = fullname
+                fullnames[fullname] = node
+                names.setdefault(name, []).append(node)
+                nodes.append(node)
+                path.append(node)
+                prefixes.append(fullname)
+                orders.append(None)
+            path[-1].ip = ip
+            orders[-1] = order
+        ips = topology.ips
+        for node in nodes:
+            if node.ip is not None:
+                ips.setdefault(node.ip, []).append(node)
+        topology.generation += 1
+        return topology
+
+    @classmethod
+    def deserialize_stream(cls, reader, smark='{', emark='}', sep='$',
+                           nsmark='(', nemark=')', nsep=','):
+        """Deserialize from a reader without reading past the topology."""
         ch = reader.read(1)
         if ch != smark:
             raise Topology.SMarkError(ch)
@@ -273,3 +857,794 @@ class Topology(object):
         if ch != emark:
             raise Topology.EMarkError(ch)
         return topology
+
+
+class IpIndex(object):
+    """Sorted address intervals of nodes, for cidr and longest prefix
+    queries in O(log n).
+
+    A node ip is an IPv4 or IPv6 address, or a network like 10.3.0.0/16.
+    IPv4 is mapped into the IPv6 space, ::ffff:0:0/96. Other ips are not
+    indexed.
+
+    init arguments:
+    nodes: the nodes to index
+
+    methods:
+    interval: the (first, last) integer addresses of an ip or cidr
+    within: the nodes within a cidr
+    longest: the node with the longest prefix holding an ip or cidr
+    """
+    class AddressError(Exception):
+        pass
+
+    V4MAPPED = 0xffff << 32
+
+    def __init__(self, nodes):
+        intervals = []
+        for node in nodes:
+            try:
+                first, last = IpIndex.interval(node.ip)
+            except IpIndex.AddressError:
+                continue
+            intervals.append((first, -last, node))
+        # larger networks first among equal starts
+        intervals.sort(key=lambda item: item[:2])
+        self.starts = [first for first, last, node in intervals]
+        self.ends = [-last for first, last, node in intervals]
+        self.nodes = [node for first, last, node in intervals]
+        # index of the smallest enclosing network, or -1
+        self.parents = []
+        stack = []
+        for i in range(len(intervals)):
+            while (len(stack) != 0) and (self.ends[stack[-1]] <
+                                         self.starts[i]):
+                stack.pop()
+            self.parents.append(-1 if len(stack) == 0 else stack[-1])
+            stack.append(i)
+
+    def __len__(self):
+        return len(self.nodes)
+
+    @classmethod
+    def interval(cls, ip):
+        """Return the (first, last) integer addresses of ip, raise
+        AddressError if it is not an address or a cidr."""
+        if not isinstance(ip, basestring):
+            raise IpIndex.AddressError('Not an address: %r' % (ip,))
+        address, slash, length = ip.partition('/')
+        try:
+            if ':' in address:
+                high, low = struct.unpack(
+                    '!QQ', socket.inet_pton(socket.AF_INET6, address))
+                value = (high << 64) | low
+                bits = 128
+            else:
+                value = IpIndex.V4MAPPED | struct.unpack(
+                    '!I', socket.inet_pton(socket.AF_INET, address))[0]
+                bits = 32
+            length = int(length) if slash else bits
+        except (socket.error, ValueError):
+            raise IpIndex.AddressError('Not an address: %s' % (ip))
+        if (length < 0) or (length > bits):
+            raise IpIndex.AddressError('Bad prefix length: %s' % (ip))
+        hostmask = (1 << (bits - length)) - 1
+        return (value & ~hostmask, value | hostmask)
+
+    def within(self, cidr):
+        """Return the nodes whose interval is within the cidr."""
+        first, last = IpIndex.interval(cidr)
+        i = bisect.bisect_left(self.starts, first)
+        j = bisect.bisect_right(self.starts, last)
+        return [self.nodes[k] for k in xrange(i, j) if self.ends[k] <= last]
+
+    def longest(self, ip):
+        """Return the node with the smallest interval holding the ip or
+        cidr, or None."""
+        first, last = IpIndex.interval(ip)
+        # the last interval starting at first or before, or one of its
+        # enclosing networks, since the networks nest
+        i = bisect.bisect_right(self.starts, first) - 1
+        while (i != -1) and (self.ends[i] < last):
+            i = self.parents[i]
+        return None if i == -1 else self.nodes[i]
+
+
+class TopologyDiff(object):
+    """The changes between two topologies, from Topology.diff().
+
+    added: (fullname, ip) of the added nodes, parents first.
+    removed: full names of the removed subtrees.
+    moved: (fullname, new parent fullname) of the moved subtrees.
+    ipchanged: (fullname, ip) of the nodes with a new ip.
+    """
+    def __init__(self):
+        self.added = []
+        self.removed = []
+        self.moved = []
+        self.ipchanged = []
+
+    def __len__(self):
+        return (len(self.added) + len(self.removed) + len(self.moved) +
+                len(self.ipchanged))
+
+    @classmethod
+    def serialize(cls, diff, writer):
+        # a None ip is written as a 1-tuple
+        def record(fullname, ip):
+            return (fullname,) if ip is None else (fullname, ip)
+        SerializeTool().serialize(
+            ([record(f, ip) for f, ip in diff.added], diff.removed,
+             [tuple(move) for move in diff.moved],
+             [record(f, ip) for f, ip in diff.ipchanged]), writer)
+
+    @classmethod
+    def deserialize(cls, reader):
+        def record(item):
+            return (item[0], None) if len(item) == 1 else item
+        added, removed, moved, ipchanged = SerializeTool().deserialize(
+            reader)
+        diff = TopologyDiff()
+        diff.added = [record(item) for item in added]
+        diff.removed = removed
+        diff.moved = moved
+        diff.ipchanged = [record(item) for item in ipchanged]
+        return diff
+
+
+class Placement(object):
+    """Pick leaves of a topology, spread over groups and close to a node.
+
+    The leaves are kept in preorder, the leaf children of a node before its
+    other children, so that the leaves under any node are a range, and
+    grouped by their ancestor at the spread level, e.g. by rack, each
+    group being a range too. A WeightTree of the leaf weights and one of
+    the group weights give weighted picks in a range in O(log n). A pick
+    takes its weight out of the trees, and its group once full, so place()
+    runs in O((k + excluded leaves) log n) without rejection sampling. The
+    trees are restored after each call and rebuilt when the topology
+    changes.
+
+    The hops from a node to a leaf depend on the depth of the leaf, so when
+    leaves are at several depths each depth also gets its own pair of
+    trees, and the picks near a node go by (ancestor range, leaf depth)
+    bands in the order of their hops.
+
+    init arguments:
+        topology: a Topology.
+        scope: the full name of the node to place under, root if None.
+        level: the level of the groups, the parents of the leaves if None.
+        weight: the capacity of a leaf, a dict or a function of the leaf,
+            1 by default. A leaf of weight 0 is never picked.
+
+    methods:
+        place(): pick k leaves. Calls are serialized by a lock.
+    """
+    class NotEnough(Exception):
+        pass
+
+    def __init__(self, topology, scope=None, level=None, weight=None):
+        self.topology = topology
+        self.scope = scope
+        self.level = level
+        self.weight = weight
+        self.generation = -1
+        self.lock = Lock()
+
+    def build(self):
+        topology = self.topology
+        top = topology.root if self.scope is None else topology.getnode(
+            self.scope)
+        if top is None:
+            raise ValueError('No scope %s.' % (self.scope))
+        leaves = []
+        groupof = []
+        gstart = []
+        groupindex = {}
+        # node -> range of its leaves, set when the node is left
+        spans = {}
+        stack = [(top, False)]
+        while len(stack) != 0:
+            node, done = stack.pop()
+            if done:
+                spans[node] = (spans[node], len(leaves))
+                continue
+            if len(node.children) != 0:
+                spans[node] = len(leaves)
+                stack.append((node, True))
+                stack.extend(reversed(
+                    [(child, False) for child in node.children
+                     if len(child.children) != 0]))
+                stack.extend(reversed(
+                    [(child, False) for child in node.children
+                     if len(child.children) == 0]))
+                continue
+            group = self.group(node)
+            if group not in groupindex:
+                groupindex[group] = len(gstart)
+                gstart.append(len(leaves))
+            groupof.append(groupindex[group])
+            spans[node] = (len(leaves), len(leaves) + 1)
+            leaves.append(node)
+        gstart.append(len(leaves))
+        self.top = top
+        self.leaves = leaves
+        self.spans = spans
+        self.groupof = groupof
+        self.gstart = gstart
+        self.weights = [self.leafweight(leaf) for leaf in self.leaves]
+        self.depthof = [leaf.level() for leaf in self.leaves]
+        # a range with a leaf left weighs more than this despite rounding
+        self.eps = 0.5 * min([w for w in self.weights if w > 0] or [0.0])
+        # the trees of all the leaves under None, and of each depth
+        self.leaftrees = {}
+        self.grouptrees = {}
+        self.maketrees(None, self.weights)
+        depths = sorted(set(self.depthof))
+        for depth in depths:
+            if len(depths) == 1:
+                self.leaftrees[depth] = self.leaftrees[None]
+                self.grouptrees[depth] = self.grouptrees[None]
+            else:
+                self.maketrees(depth, [
+                    w if d == depth else 0.0
+                    for w, d in izip(self.weights, self.depthof)])
+        self.depths = depths
+        # the distinct trees, to begin and roll back
+        self.trees = []
+        for tree in self.leaftrees.values() + self.grouptrees.values():
+            if not any(tree is other for other in self.trees):
+                self.trees.append(tree)
+        self.generation = topology.generation
+
+    def maketrees(self, key, weights):
+        gstart = self.gstart
+        self.leaftrees[key] = WeightTree(weights)
+        self.grouptrees[key] = WeightTree(
+            [sum(weights[gstart[g] : gstart[g + 1]])
+             for g in range(len(gstart) - 1)])
+
+    def group(self, leaf):
+        if self.level is None:
+            return leaf.parent
+        node = leaf
+        while node.level() > self.level:
+            node = node.parent
+        return node
+
+    def leafweight(self, leaf):
+        if self.weight is None:
+            return 1.0
+        if callable(self.weight):
+            return float(self.weight(leaf))
+        return float(self.weight.get(leaf, 1.0))
+
+    def range(self, node):
+        """The range of the leaves under node, None if out of scope."""
+        span = self.spans.get(node)
+        if (span is None) or (span[0] == span[1]):
+            return None
+        return span
+
+    def place(self, k, exclude=None, near=None, spread=True, maxpergroup=1):
+        """Pick k leaves.
+
+        exclude: nodes whose leaves are not picked.
+        near: pick the leaves closest to this node in hops first.
+        spread: pick at most maxpergroup leaves in a group.
+        Raise Placement.NotEnough if fewer than k leaves can be picked.
+        """
+        with self.lock:
+            if self.generation != self.topology.generation:
+                self.build()
+            self.taken = set([])
+            self.full = set([])
+            for tree in self.trees:
+                tree.begin()
+            try:
+                return self.picks(k, exclude, near, spread, maxpergroup)
+            finally:
+                for tree in self.trees:
+                    tree.rollback()
+
+    def picks(self, k, exclude, near, spread, maxpergroup):
+        for node in (exclude or []):
+            span = self.range(node)
+            if span is not None:
+                self.exclude(span)
+        bands = self.bands(near)
+        counts = {}
+        result = []
+        band = 0
+        while len(result) < k:
+            while (band < len(bands)) and (
+                    self.available(*bands[band]) <= self.eps):
+                band += 1
+            if band == len(bands):
+                raise Placement.NotEnough(
+                    'Only %s of %s leaves.' % (len(result), k))
+            index = self.pick(*bands[band])
+            result.append(self.leaves[index])
+            self.take(index)
+            group = self.groupof[index]
+            counts[group] = counts.get(group, 0) + 1
+            if spread and (counts[group] >= maxpergroup):
+                self.takegroup(group)
+        return result
+
+    def bands(self, near):
+        """The (leaf range, leaf depth) bands to pick from in turn, the
+        leaves under near and each of its ancestors in scope by their
+        hops from near. A band leaves out the closer bands, which are
+        empty by the time it is reached."""
+        whole = (0, len(self.leaves))
+        if near is None:
+            return [(whole, None)]
+        spans = []
+        node = near
+        while node is not None:
+            span = self.range(node)
+            if (span is not None) and ((len(spans) == 0) or
+                                       (span[0] != spans[-1][0])):
+                spans.append((span, node.level()))
+            if node is self.top:
+                break
+            node = node.parent
+        if (len(spans) == 0) or (spans[-1][0] != whole):
+            spans.append((whole, self.top.level()))
+        level = near.level()
+        bands = []
+        for span, ancestor in spans:
+            for depth in self.depths:
+                hops = level + depth - 2 * ancestor
+                bands.append((hops, len(bands), span, depth))
+        bands.sort()
+        return [(span, depth) for hops, i, span, depth in bands]
+
+    def groups(self, span):
+        # the groups of a range, which holds whole groups or is in one
+        return (self.groupof[span[0]], self.groupof[span[1] - 1] + 1)
+
+    def available(self, span, depth):
+        glo, ghi = self.groups(span)
+        if ghi - glo == 1:
+            if glo in self.full:
+                return 0.0
+            return self.leaftrees[depth].range(span[0], span[1])
+        return self.grouptrees[depth].range(glo, ghi)
+
+    def pick(self, span, depth):
+        glo, ghi = self.groups(span)
+        if ghi - glo > 1:
+            group = self.grouptrees[depth].pick(glo, ghi)
+            span = (self.gstart[group], self.gstart[group + 1])
+        index = self.leaftrees[depth].pick(span[0], span[1])
+        if ((index in self.taken) or (self.weights[index] <= 0) or
+                ((depth is not None) and (self.depthof[index] != depth))):
+            # a rounding error hit a leaf out of the picks, take the
+            # heaviest one left
+            index = max([i for i in range(span[0], span[1])
+                         if (i not in self.taken) and (
+                             (depth is None) or (self.depthof[i] == depth))],
+                        key=lambda i: self.weights[i])
+        return index
+
+    def take(self, index):
+        if index in self.taken:
+            return
+        self.taken.add(index)
+        weight = self.weights[index]
+        group = self.groupof[index]
+        # the trees of a single depth are the ones of all the leaves
+        keys = [None]
+        if len(self.depths) > 1:
+            keys.append(self.depthof[index])
+        for key in keys:
+            self.leaftrees[key].add(index, -weight)
+            if group not in self.full:
+                self.grouptrees[key].add(group, -weight)
+
+    def takegroup(self, group):
+        if group in self.full:
+            return
+        self.full.add(group)
+        for key in self.grouptrees:
+            tree = self.grouptrees[key]
+            if (key is not None) and (tree is self.grouptrees[None]):
+                continue
+            tree.add(group, -tree.range(group, group + 1))
+
+    def exclude(self, span):
+        glo, ghi = self.groups(span)
+        if (ghi - glo == 1) and (span != (self.gstart[glo],
+                                          self.gstart[ghi])):
+            for index in range(span[0], span[1]):
+                self.take(index)
+        else:
+            for group in range(glo, ghi):
+                self.takegroup(group)
+
+
+class CompactNode(object):
+    """A read-only view of a node of a CompactTopology."""
+    __slots__ = ('topology', 'index')
+
+    def __init__(self, topology, index):
+        self.topology = topology
+        self.index = index
+
+    @property
+    def name(self):
+        top = self.topology
+        return top.names[top.nameidx[self.index]]
+
+    @property
+    def ip(self):
+        top = self.topology
+        ipidx = top.ipidx[self.index]
+        return None if ipidx < 0 else top.ips[ipidx]
+
+    @property
+    def parent(self):
+        parent = self.topology.parent[self.index]
+        return None if parent < 0 else CompactNode(self.topology, parent)
+
+    @property
+    def children(self):
+        return [CompactNode(self.topology, i)
+                for i in self.topology.childindexes(self.index)]
+
+    def getchild(self, name):
+        """Get the child by name."""
+        index = self.topology.childindex(self.index, name)
+        return None if index < 0 else CompactNode(self.topology, index)
+
+    def fullname(self):
+        """The full name of this node."""
+        return self.topology.fullname(self.index)
+
+    def level(self):
+        """Current level of this node. The topmost level is 0."""
+        return self.topology.depth[self.index]
+
+    def __eq__(self, other):
+        return (isinstance(other, CompactNode) and
+                (self.topology is other.topology) and
+                (self.index == other.index))
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash((id(self.topology), self.index))
+
+    def __str__(self):
+        return '(%s, %s)' % (self.fullname(), self.ip)
+
+
+class CompactTopology(object):
+    """An immutable topology held in flat arrays instead of Node objects.
+
+    Nodes are numbered in preorder from the root at 0, so the subtree of
+    node i is the range [i, end[i]). Names are interned in one list and
+    ips in another, and each node keeps indexes into them. The arrays are
+    not touched by reference counting, so pages forked to worker processes
+    stay shared, and to_bytes() gives a buffer to map into other
+    processes. Queries return CompactNode views.
+
+    init arguments:
+        parent, nameidx, ipidx: arrays of int by node, -1 for none. The
+            firstchild, nextsibling, depth and end arrays are derived.
+        names: the interned names.
+        ips: the ips.
+
+    methods:
+        from_topology(): build from a Topology.
+        getnode(), getleaves(), getracks(), getnhops(), find_by_name(),
+        find_by_ip(): as in Topology.
+        to_bytes(), from_bytes(): serialize the arrays.
+    """
+    # the arrays written by write(), the others are derived from them
+    FIELDS = ('parent', 'nameidx', 'ipidx')
+
+    def __init__(self, parent, nameidx, ipidx, names, ips):
+        self.parent = parent
+        self.derive()
+        self.nameidx = nameidx
+        self.ipidx = ipidx
+        self.names = names
+        self.ips = ips
+        # lookup tables built on first use
+        self.namemap = None
+        self.ipmap = None
+        self.leaves = {}
+        self.racks = {}
+        self.root = CompactNode(self, 0)
+
+    def __len__(self):
+        return len(self.parent)
+
+    def derive(self):
+        """Build depth, firstchild, nextsibling and end from parent."""
+        parent = self.parent
+        n = len(parent)
+        depth = array.array('i', [0]) * n
+        # parents come before their children in preorder
+        for i in xrange(1, n):
+            depth[i] = depth[parent[i]] + 1
+        # link the children backwards so that they keep their order, and
+        # extend the subtree ranges of the parents
+        firstchild = array.array('i', [-1]) * n
+        nextsibling = array.array('i', [-1]) * n
+        end = array.array('i', xrange(1, n + 1))
+        for i in xrange(n - 1, 0, -1):
+            p = parent[i]
+            nextsibling[i] = firstchild[p]
+            firstchild[p] = i
+            if end[i] > end[p]:
+                end[p] = end[i]
+        self.depth = depth
+        self.firstchild = firstchild
+        self.nextsibling = nextsibling
+        self.end = end
+
+    @classmethod
+    def from_topology(cls, topology):
+        parent = array.array('i')
+        nameidx = array.array('i')
+        ipidx = array.array('i')
+        names = []
+        namemap = {}
+        ips = []
+        ipmap = {}
+        stack = [(topology.root, -1)]
+        while len(stack) != 0:
+            node, pindex = stack.pop()
+            index = len(parent)
+            parent.append(pindex)
+            if node.name not in namemap:
+                namemap[node.name] = len(names)
+                names.append(intern(node.name))
+            nameidx.append(namemap[node.name])
+            if node.ip is None:
+                ipidx.append(-1)
+            else:
+                if node.ip not in ipmap:
+                    ipmap[node.ip] = len(ips)
+                    ips.append(node.ip)
+                ipidx.append(ipmap[node.ip])
+            for child in reversed(node.children):
+                stack.append((child, index))
+        return cls(parent, nameidx, ipidx, names, ips)
+
+    def childindexes(self, index):
+        child = self.firstchild[index]
+        result = []
+        while child >= 0:
+            result.append(child)
+            child = self.nextsibling[child]
+        return result
+
+    def childindex(self, index, name):
+        child = self.firstchild[index]
+        names = self.names
+        nameidx = self.nameidx
+        while child >= 0:
+            if names[nameidx[child]] == name:
+                return child
+            child = self.nextsibling[child]
+        return -1
+
+    def fullname(self, index):
+        result = []
+        while index > 0:
+            result.append(self.names[self.nameidx[index]])
+            index = self.parent[index]
+        result.reverse()
+        return '/' + '/'.join(result)
+
+    def getnode(self, fullname):
+        """Get the node by full name."""
+        fullname = StringUtil.normalize_path(fullname)
+        index = 0
+        for name in fullname.split('/')[1:]:
+            if name == '':
+                continue
+            index = self.childindex(index, name)
+            if index < 0:
+                return None
+        return CompactNode(self, index)
+
+    def getleaves(self, scope=None):
+        """Get all leaf node under scope."""
+        return list(self.cachedleaves(scope))
+
+    def getracks(self, scope=None):
+        """Get all racks under scope."""
+        scope = '/' if scope is None else StringUtil.normalize_path(scope)
+        racks = self.racks.get(scope)
+        if racks is None:
+            racks = sorted(set([leaf.parent
+                                for leaf in self.cachedleaves(scope)]),
+                           key=str)
+            self.racks[scope] = racks
+        return list(racks)
+
+    def cachedleaves(self, scope):
+        scope = '/' if scope is None else StringUtil.normalize_path(scope)
+        leaves = self.leaves.get(scope)
+        if leaves is None:
+            node = self.getnode(scope)
+            firstchild = self.firstchild
+            # the subtree of a node is a range in preorder
+            leaves = [CompactNode(self, i)
+                      for i in xrange(node.index + 1, self.end[node.index])
+                      if firstchild[i] < 0]
+            leaves.sort(key=str)
+            self.leaves[scope] = leaves
+        return leaves
+
+    def find_by_name(self, name):
+        """Search the node by its name, the first one in breadth first
+        order if several."""
+        # among nodes of a depth, preorder is breadth first order
+        if self.namemap is None:
+            namemap = {}
+            for index in xrange(len(self.parent) - 1, -1, -1):
+                nodename = self.names[self.nameidx[index]]
+                other = namemap.get(nodename)
+                if (other is None) or (self.depth[index] <= self.depth[other]):
+                    namemap[nodename] = index
+            self.namemap = namemap
+        index = self.namemap.get(name)
+        return None if index is None else CompactNode(self, index)
+
+    def find_by_ip(self, ip):
+        """Search the node by its ip, the first one in breadth first order
+        if several."""
+        if ip is None:
+            return self.root
+        if self.ipmap is None:
+            ipmap = {}
+            for index in xrange(len(self.ipidx) - 1, -1, -1):
+                if self.ipidx[index] < 0:
+                    continue
+                nodeip = self.ips[self.ipidx[index]]
+                other = ipmap.get(nodeip)
+                if (other is None) or (self.depth[index] <= self.depth[other]):
+                    ipmap[nodeip] = index
+            self.ipmap = ipmap
+        index = self.ipmap.get(ip)
+        return None if index is None else CompactNode(self, index)
+
+    def getnhops(self, node1, node2):
+        index1 = node1.index
+        index2 = node2.index
+        parent = self.parent
+        depth = self.depth
+        dis = 0
+        while depth[index1] > depth[index2]:
+            index1 = parent[index1]
+            dis += 1
+        while depth[index2] > depth[index1]:
+            index2 = parent[index2]
+            dis += 1
+        while index1 != index2:
+            index1 = parent[index1]
+            index2 = parent[index2]
+            dis += 2
+        return dis
+
+    @classmethod
+    def narrow(cls, values):
+        """The array of values with the smallest signed typecode."""
+        low = min(values) if len(values) != 0 else 0
+        high = max(values) if len(values) != 0 else 0
+        for typecode in ('b', 'h', 'i'):
+            bits = 8 * array.array(typecode).itemsize - 1
+            if (low >= -(1 << bits)) and (high < (1 << bits)):
+                break
+        return array.array(typecode, values)
+
+    @classmethod
+    def encode(cls, indexes):
+        # names and ips are numbered by first use in preorder, so a first
+        # use is written as -2 and only repeats keep their index
+        result = []
+        count = 0
+        for index in indexes:
+            if index == count:
+                result.append(-2)
+                count += 1
+            else:
+                result.append(index)
+        return result
+
+    @classmethod
+    def decode(cls, values):
+        result = array.array('i', values)
+        count = 0
+        for i in xrange(len(result)):
+            if result[i] == -2:
+                result[i] = count
+                count += 1
+        return result
+
+    def write(self, writer):
+        """Write the parent, nameidx and ipidx arrays, each with the
+        smallest typecode that holds it, and the names and ips joined by
+        NUL chars, as one SerializeTool tuple. The first use of a name or
+        an ip is written as -2, so unique ones take a byte."""
+        for string in itertools.chain(self.names, self.ips):
+            if '\0' in string:
+                raise ValueError('NUL char in name or ip: %r' % (string))
+        narrow = CompactTopology.narrow
+        encode = CompactTopology.encode
+        SerializeTool().serialize(
+            (narrow(self.parent), narrow(encode(self.nameidx)),
+             narrow(encode(self.ipidx)), len(self.names),
+             '\0'.join(self.names), len(self.ips), '\0'.join(self.ips)),
+            writer)
+
+    @classmethod
+    def read(cls, reader):
+        items = SerializeTool().deserialize(reader)
+        if len(items) != len(CompactTopology.FIELDS) + 4:
+            raise ValueError('Not a compact topology.')
+        nnames, names, nips, ips = items[-4:]
+        names = [intern(name) for name in names.split('\0')]
+        ips = ips.split('\0') if nips != 0 else []
+        if (len(names) != nnames) or (len(ips) != nips):
+            raise ValueError('Corrupted names or ips.')
+        parent, nameidx, ipidx = items[:-4]
+        if parent.typecode != 'i':
+            parent = array.array('i', parent)
+        return cls(parent, CompactTopology.decode(nameidx),
+                   CompactTopology.decode(ipidx), names, ips)
+
+    def to_bytes(self):
+        """The arrays and names as a string, see from_bytes()."""
+        writer = StringIO()
+        self.write(writer)
+        return writer.getvalue()
+
+    @classmethod
+    def from_bytes(cls, string):
+        return cls.read(StringIO(string))
+
+    def to_topology(self):
+        """Build a Topology of Node objects, in one pass over the arrays.
+        The nodes are linked and indexed as they are made."""
+        names = self.names
+        ips = self.ips
+        parent = self.parent
+        depth = self.depth
+        nameidx = self.nameidx
+        ipidx = self.ipidx
+        topology = Topology()
+        fullnames = topology.fullnames
+        bynames = topology.names
+        byips = topology.ips
+        nodes = [topology.root] + [None] * (len(parent) - 1)
+        prefixes = [''] + [None] * (len(parent) - 1)
+        # parents come before their children in preorder
+        for i in xrange(1, len(parent)):
+            name = names[nameidx[i]]
+            ip = None if ipidx[i] < 0 else ips[ipidx[i]]
+            node = Node(name, ip)
+            up = nodes[parent[i]]
+            node.parent = up
+            up.children.append(node)
+            up.childmap.setdefault(name, node)
+            fullname = prefixes[parent[i]] + '/' + name
+            node.topology = topology
+            node.depth = depth[i]
+            node.fullpath = fullname
+            fullnames.setdefault(fullname, node)
+            bynames.setdefault(name, []).append(node)
+            if ip is not None:
+                byips.setdefault(ip, []).append(node)
+            nodes[i] = node
+            prefixes[i] = fullname
+        topology.generation += 1
+        return topology
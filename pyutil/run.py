@@ -1,16 +1,78 @@
+import ctypes
+import ctypes.util
+import heapq
+import itertools
+import json
 import logging
+import math
+import os
+import pipes
+import platform
+import random
+import resource
+import select
 import shlex
+import signal
+import struct
 import subprocess
 import time
+import uuid
 from collections import deque
-from threading import Thread, Condition
+from StringIO import StringIO
+from threading import Thread, Condition, Lock, RLock, Timer
+from threading import current_thread
 
 from pyutil.fio import StdPipeWriter
+from pyutil.serial import SerializeTool
+from pyutil.stats import RollingHist
 from pyutil.string import NLinesStdStringWriter
 
+class TimeUtil(object):
+    # clock_gettime from libc, False when unavailable
+    _clock_gettime = None
+
+    class _timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    @classmethod
+    def monotonic(cls):
+        """Seconds on a clock that never goes back, unlike time.time().
+
+        Python 2 has no time.monotonic(), so clock_gettime is called from
+        libc with the Linux CLOCK_MONOTONIC id. On other platforms, or
+        without clock_gettime in libc, this falls back to time.time().
+        """
+        if hasattr(time, 'monotonic'):
+            return time.monotonic()
+        if cls._clock_gettime is None:
+            cls._clock_gettime = False
+            if platform.system() == 'Linux':
+                try:
+                    libc = ctypes.CDLL(
+                        ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+                    clock_gettime = libc.clock_gettime
+                    clock_gettime.argtypes = [
+                        ctypes.c_int, ctypes.POINTER(TimeUtil._timespec)]
+                    cls._clock_gettime = clock_gettime
+                except (OSError, AttributeError):
+                    pass
+        if cls._clock_gettime is False:
+            return time.time()
+        ts = TimeUtil._timespec()
+        # CLOCK_MONOTONIC is 1 on Linux
+        if cls._clock_gettime(1, ctypes.byref(ts)) != 0:
+            raise OSError(ctypes.get_errno(), 'clock_gettime failed.')
+        return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
 class Alarm(Thread):
     """A background alarm.
 
+    The alarm times are start + at + k * interval on a monotonic clock, so
+    they do not drift with the time taken by function. Alarm times missed
+    while function runs are skipped, not run back to back.
+
     init arguments:
         function: work to do at each alarm time.
         interval: the interval between two alarms.
@@ -29,92 +91,495 @@ class Alarm(Thread):
         self.stopped = False
 
     def run(self):
-        time.sleep(self.at)
-        while not self.stopped:
+        deadline = TimeUtil.monotonic() + self.at
+        while True:
+            delay = deadline - TimeUtil.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            if self.stopped:
+                break
             self.function()
-            time.sleep(self.interval)
+            deadline += self.interval
+            now = TimeUtil.monotonic()
+            if deadline <= now:
+                deadline += (int((now - deadline) / self.interval) + 1) * (
+                    self.interval)
 
     def stop(self):
         self.stopped = True
 
 
+class Scheduler(Thread):
+    """Run any number of periodic and one-shot timers on one thread.
+
+    Timers are kept in a heap by deadline on a monotonic clock. A periodic
+    timer fires at its first deadline plus multiples of its interval, so it
+    does not drift. If a run ends after the next deadline, the missed
+    deadlines are skipped and counted as overruns. Offloaded timers only
+    add a FuncTask to the pool, so a slow function does not delay the
+    others; an offloaded run still going at the next deadline is an
+    overrun too.
+
+    init arguments:
+        pool: the Pool to run offloaded functions.
+
+    methods:
+        schedule(): add a periodic timer.
+        call_later(): add a one-shot timer.
+        cancel(): cancel a timer.
+        stop(): stop the scheduler.
+    """
+    def __init__(self, pool=None):
+        super(Scheduler, self).__init__()
+        self.daemon = True
+        self.pool = pool
+        self.heap = []
+        self.counter = itertools.count()
+        self.cond = Condition()
+        self.stopped = False
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def schedule(self, function, interval, at=0, offload=False):
+        """Call function every interval seconds, first after at seconds."""
+        timer = SchedTimer(function, interval, offload)
+        self.push(timer, TimeUtil.monotonic() + at)
+        return timer
+
+    def call_later(self, function, delay, offload=False):
+        """Call function once after delay seconds."""
+        timer = SchedTimer(function, None, offload)
+        self.push(timer, TimeUtil.monotonic() + delay)
+        return timer
+
+    def cancel(self, timer):
+        # lazily removed from the heap when due
+        timer.cancelled = True
+
+    def push(self, timer, deadline):
+        if timer.offload and (self.pool is None):
+            raise ValueError('No pool to offload timer.')
+        with self.cond:
+            timer.deadline = deadline
+            heapq.heappush(self.heap, (deadline, next(self.counter), timer))
+            if self.heap[0][2] is timer:
+                self.cond.notify()
+
+    def run(self):
+        while True:
+            with self.cond:
+                timer = None
+                while (timer is None) and (not self.stopped):
+                    if len(self.heap) == 0:
+                        self.cond.wait(1.0)
+                        continue
+                    deadline = self.heap[0][0]
+                    delay = deadline - TimeUtil.monotonic()
+                    if delay > 0:
+                        self.cond.wait(delay)
+                        continue
+                    timer = heapq.heappop(self.heap)[2]
+                    if timer.cancelled:
+                        timer = None
+                if self.stopped:
+                    break
+            self.fire(timer)
+
+    def fire(self, timer):
+        if not timer.offload:
+            timer.nruns += 1
+            try:
+                timer.function()
+            except Exception as e:
+                self.logger.exception(e)
+        elif (timer.task is not None) and (timer.task.state != Task.FINISHED):
+            timer.noverruns += 1
+            self.logger.warn('Timer [%s] overrun: last run not finished.'
+                             % (timer))
+        else:
+            timer.task = FuncTask(timer.function)
+            try:
+                self.pool.add(timer.task)
+                timer.nruns += 1
+            except Pool.Full:
+                timer.noverruns += 1
+                self.logger.warn('Timer [%s] overrun: pool is full.'
+                                 % (timer))
+        if (timer.interval is None) or timer.cancelled:
+            return
+        deadline = timer.deadline + timer.interval
+        now = TimeUtil.monotonic()
+        if deadline <= now:
+            missed = int((now - deadline) / timer.interval) + 1
+            timer.noverruns += missed
+            self.logger.warn('Timer [%s] overrun: %s deadlines missed.'
+                             % (timer, missed))
+            deadline += missed * timer.interval
+        self.push(timer, deadline)
+
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+
+
+class SchedTimer(object):
+    """A timer of a Scheduler.
+
+    nruns counts the runs, started or handed to the pool, and noverruns
+    the deadlines that were skipped.
+    """
+    def __init__(self, function, interval, offload):
+        self.function = function
+        self.interval = interval
+        self.offload = offload
+        self.deadline = None
+        self.cancelled = False
+        self.task = None
+        self.nruns = 0
+        self.noverruns = 0
+
+    def __str__(self):
+        return getattr(self.function, '__name__', str(self.function))
+
+
 class Pool(object):
     """A pool of threads to run the tasks.
 
     init arguments:
         nthreads: number of threads.
         qlen: max number of tasks in the queue.
+        queue: the task queue, TaskQueue (FIFO) by default.
+        expire: what to do with tasks whose deadline passed before they
+            start, 'fail' puts them into the failed list, 'drop'
+            discards them.
+        stealing: give each runner its own FIFO queue and let idle runners
+            steal from the others, instead of sharing one queue. The queue
+            argument is ignored in this mode.
+        logtasks: log every task start and success at INFO level. Turn off
+            for high task rates and use a TaskListener instead.
+        keepsucceeded: keep succeeded tasks for fetch_succeeded(). Turn off
+            for long running pools that do not need them.
+        speculate: a percentile (0 to 1) of the run time of succeeded
+            tasks. A task running longer gets a copy from Task.clone() and
+            the first copy to succeed wins, the other is killed.
+        journal: a TaskJournal. Finished tasks with a taskid are recorded
+            in it, and tasks it holds as succeeded are not run again.
+    elastic mode arguments, used when nthreads is None:
+        minthreads: number of runners always kept.
+        maxthreads: max number of runners, unbounded if None.
+        idletime: seconds after which an idle runner retires, never if
+            None.
+        latency: target seconds for the queued tasks to finish. If set, the
+            pool only grows as much as the mean task duration requires.
 
     methods:
         start(): start the pool.
         add(): add a command to the queue for processing.
             raise Pool.Full exception if queue is full.
+        add_many(): add a list of commands with one lock acquisition per
+            queue.
+        submit(): add a command and return a TaskFuture.
+        feed(): add commands from an iterable, blocking while full.
         wait(): wait until all the commands are proccessed.
         fetch_succeeded(): return the list of succeeded commands.
         fetch_failed(): return the list of failed commands.
+        fetch_cancelled(): return the list of commands cancelled by close().
+        as_completed(): iterate over finished commands as they finish.
         qlen(): return number of commands to run.
-        close(): close the pool.
+        add_listener(): add a TaskListener for task events, such as
+            TaskStats and TaskTracer.
+        close(): cancel the queued commands, kill the running ones and join
+            the runners. With drain, wait for the commands first.
     """
     class Full(Exception):
         pass
 
-    def __init__(self, nthreads=None, qlen=1000000):
+    def __init__(self, nthreads=None, qlen=1000000, queue=None,
+                 expire='fail', stealing=False, minthreads=0,
+                 maxthreads=None, idletime=None, latency=None, logtasks=True,
+                 keepsucceeded=True, speculate=None, journal=None):
+        if expire not in ('fail', 'drop'):
+            raise ValueError('Unknown expire policy: %s' % (expire))
         self.nthreads = nthreads
         self.t_start = time.time()
-        self.torun = deque()
+        self.torun = TaskQueue() if queue is None else queue
+        self.expire = expire
+        self.nexpired = 0
+        self.stealing = stealing
+        self.npending = 0
+        self.nidle = 0
+        self.nextrunner = 0
+        self.minthreads = minthreads
+        self.maxthreads = maxthreads
+        self.idletime = idletime
+        self.latency = latency
+        self.duration = None
+        self.logtasks = logtasks
+        self.keepsucceeded = keepsucceeded
+        self.stream = None
+        self.streamlen = 0
+        self.speculate = speculate
+        self.minsamples = 20
+        self.samples = deque(maxlen=1000)
+        self.monitor = None
+        self.journal = journal
+        self.nresumed = 0
         self.succeeded = deque()
         self.failed = deque()
+        self.cancelled = deque()
         self.threads = []
         self.maxqlen = qlen
-        self.new = Condition()
+        self.lock = RLock()
+        self.new = Condition(self.lock)
+        self.notfull = Condition(self.lock)
+        self.nblocked = 0
         self.done = Condition()
         self.closed = False
+        self.listeners = []
         self.logger = logging.getLogger(self.__class__.__name__)
-        if self.nthreads is not None:
-            for i in range(self.nthreads):
-                thread = TaskRunner(self)
-                thread.daemon = True
-                self.threads.append(thread)
+        if journal is not None:
+            self.add_listener(journal)
+        ninit = self.nthreads if self.nthreads is not None else minthreads
+        for i in range(ninit):
+            thread = TaskRunner(self)
+            thread.daemon = True
+            self.threads.append(thread)
 
     def __enter__(self):
         self.start()
         return self
 
     def __exit__(self, type, value, traceback):
-        self.close()
+        # do not hold an exception, e.g. KeyboardInterrupt, on the runners
+        self.close(timeout=None if type is None else 0)
 
     def start(self):
         for thread in self.threads:
             thread.start()
+        if self.speculate is not None:
+            self.monitor = Alarm(self.straggle, 0.1)
+            self.monitor.start()
 
     def qlen(self):
-        return len(self.torun)
+        if not self.stealing:
+            return len(self.torun)
+        return sum([len(thread.local) for thread in self.threads])
+
+    def add(self, task, block=False, timeout=None):
+        """Add a task to the queue for processing.
+
+        If the queue is full, raise Pool.Full, or with block wait for room
+        until timeout and raise Pool.Full if there is still none.
+        """
+        self.add_many([task], block, timeout)
+
+    def add_many(self, tasks, block=False, timeout=None):
+        """Add a list of tasks to the queue for processing.
 
-    def add(self, task):
-        """Add a task to the queue for processing. """
+        The tasks are queued as a whole, or not at all if the queue does not
+        have enough room. Blocking works as add().
+        """
+        tasks = list(tasks)
+        if self.journal is not None:
+            tasks = self.resume(tasks)
+        if self.closed:
+            with self.done:
+                self.npending += len(tasks)
+            for task in tasks:
+                self.cancel(task)
+            return
+        if len(tasks) == 0:
+            return
+        if block and (len(tasks) > self.maxqlen):
+            raise ValueError('%s tasks never fit in queue of length %s.'
+                             % (len(tasks), self.maxqlen))
+        elastic = (self.nthreads is None)
+        if self.stealing and not elastic:
+            # the queue length is checked without the lock, so concurrent
+            # producers may overshoot it by a chunk each
+            if self.qlen() + len(tasks) > self.maxqlen:
+                with self.new:
+                    self.room(len(tasks), block, timeout)
+            self.push(tasks)
+            # see TaskRunner.next_task() for why no wakeup is lost
+            if self.nidle > 0:
+                with self.new:
+                    self.new.notify(len(tasks))
+            return
+        with self.new:
+            if elastic and len(self.threads) == 0:
+                self.spawn()
+            self.room(len(tasks), block, timeout)
+            self.push(tasks)
+            self.new.notify(len(tasks))
+            if elastic:
+                self.grow()
+
+    def resume(self, tasks):
+        """Finish the tasks the journal holds as succeeded without running
+        them, and return the others."""
+        todo = []
+        for task in tasks:
+            record = self.journal.succeeded(task.taskid)
+            if record is None:
+                todo.append(task)
+                continue
+            task.t_start, task.t_end = record[3], record[4]
+            task.state = Task.FINISHED
+            task.success = True
+            self.nresumed += 1
+            with self.done:
+                self.npending += 1
+            self.finish(task, keep=False)
+        return todo
+
+    def submit(self, task, block=True, timeout=None):
+        """Add a task and return a TaskFuture for it.
+
+        Unlike add(), wait for room in the queue by default.
+        """
+        future = TaskFuture(task)
+        task.future = future
+        self.add(task, block, timeout)
+        return future
+
+    def feed(self, tasks, batch=100, timeout=None):
+        """Add tasks from an iterable, blocking while the queue is full.
+
+        Tasks are pulled from the iterable only when there is room, so a
+        generator of millions of tasks only keeps about qlen of them alive.
+        """
+        batch = max(1, min(batch, self.maxqlen))
+        chunk = []
+        for task in tasks:
+            chunk.append(task)
+            if len(chunk) == batch:
+                self.add_many(chunk, True, timeout)
+                chunk = []
+        if len(chunk) != 0:
+            self.add_many(chunk, True, timeout)
+
+    def room(self, ntasks, block, timeout):
+        """Wait until ntasks more tasks fit in the queue.
+
+        A blocked producer registers itself before looking at the queue
+        length again, while runners pop a task before looking at nblocked,
+        so no wakeup is lost. Must be called with self.new held.
+        """
+        if self.qlen() + ntasks <= self.maxqlen:
+            return
+        if not block:
+            raise Pool.Full
+        ts = time.time()
+        self.nblocked += 1
+        try:
+            while self.qlen() + ntasks > self.maxqlen:
+                if timeout is None:
+                    self.notfull.wait(1.0)
+                else:
+                    left = ts + timeout - time.time()
+                    if left <= 0:
+                        raise Pool.Full
+                    self.notfull.wait(left)
+        finally:
+            self.nblocked -= 1
+
+    def push(self, tasks):
+        with self.done:
+            self.npending += len(tasks)
+        t_queued = time.time() - self.t_start
+        for task in tasks:
+            task.t_queued = t_queued
+        if len(self.listeners) != 0:
+            for task in tasks:
+                self.notify('on_queued', task)
+        if self.stealing:
+            self.distribute(tasks)
+        else:
+            for task in tasks:
+                self.torun.push(task)
+
+    def requeue(self, task):
+        """Queue a task again that is still counted as pending."""
+        if self.closed:
+            self.cancel(task)
+            return
+        task.t_queued = time.time() - self.t_start
         with self.new:
-            if self.qlen() > self.maxqlen:
-                raise Pool.Full
-            self.torun.append(task)
+            if self.stealing:
+                self.distribute([task])
+            else:
+                self.torun.push(task)
             self.new.notify()
-            nbusy = self.nthreads_working()
-        # if all threads are busy and we can launch new thread
-        if ((nbusy == len(self.threads)) and (self.nthreads is None)):
-            thread = TaskRunner(self)
-            thread.daemon = True
-            self.threads.append(thread)
-            thread.start()
+
+    def distribute(self, tasks):
+        # split tasks into one chunk per runner, round robin from the last
+        # runner used, and append each chunk under the runner's lock
+        threads = self.threads
+        nchunks = min(len(threads), len(tasks))
+        size = (len(tasks) + nchunks - 1) / nchunks
+        for i in range(nchunks):
+            chunk = tasks[i * size : (i + 1) * size]
+            if len(chunk) == 0:
+                break
+            thread = threads[(self.nextrunner + i) % len(threads)]
+            with thread.locallock:
+                thread.local.extend(chunk)
+        self.nextrunner = (self.nextrunner + nchunks) % len(threads)
+
+    def grow(self):
+        """Spawn runners for the queued tasks in elastic mode.
+
+        Without a latency target, a runner is spawned for each queued task
+        that no idle runner can take. With a target, the pool is sized by
+        Little's law from the mean task duration: n runners clear the
+        queued and running tasks in (queued + running) * duration / n.
+        Must be called with self.new held.
+        """
+        nthreads = len(self.threads)
+        nworking = self.nthreads_working()
+        want = nworking + self.qlen()
+        if (self.latency is not None) and (self.duration is not None):
+            want = int(math.ceil(want * self.duration / self.latency))
+        want = max(want, self.minthreads, 1)
+        if self.maxthreads is not None:
+            want = min(want, self.maxthreads)
+        for i in range(want - nthreads):
+            self.spawn()
+
+    def retire(self, runner, idle_since):
+        """Retire an idle runner in elastic mode.
+
+        Must be called with self.new held.
+        """
+        if ((self.nthreads is not None) or (self.idletime is None) or
+                (len(self.threads) <= self.minthreads) or
+                (time.time() - idle_since < self.idletime) or
+                (len(runner.local) != 0)):
+            return False
+        runner.closed = True
+        self.threads = [t for t in self.threads if t is not runner]
+        self.logger.debug('Runner %s retired.' % (runner.name))
+        return True
+
+    def idlewait(self):
+        # how long an idle runner waits before checking again
+        if (self.nthreads is None) and (self.idletime is not None):
+            return min(1.0, self.idletime)
+        return 1.0
+
+    def spawn(self):
+        thread = TaskRunner(self)
+        thread.daemon = True
+        self.threads.append(thread)
+        thread.start()
 
     def wait(self, timeout=None):
         """Wait until all the tasks are proccessed or timeout."""
         ts = time.time()
         while True:
-            blocking = False
-            with self.new:
-                if self.qlen() != 0:
-                    blocking = True
-                if self.nthreads_working() != 0:
-                    blocking = True
+            with self.done:
+                blocking = (self.npending != 0)
             if not blocking:
                 break
             if timeout is not None:
@@ -154,6 +619,63 @@ class Pool(object):
                 pass
         return result
 
+    def fetch_cancelled(self):
+        """Pop out all tasks that were cancelled before they ran."""
+        result = []
+        with self.done:
+            try:
+                while True:
+                    result.append(self.cancelled.popleft())
+            except IndexError:
+                pass
+        return result
+
+    def as_completed(self, timeout=None, buflen=1000):
+        """Yield finished tasks in completion order until the pool is idle.
+
+        Tasks already finished are yielded first. While iterating, finished
+        tasks go to a buffer of buflen tasks instead of the succeeded and
+        failed lists, and runners wait when the buffer is full. Stop early
+        after timeout seconds.
+        """
+        ts = time.time()
+        stream = deque()
+        with self.done:
+            if self.stream is not None:
+                raise RuntimeError('Pool is already streaming.')
+            self.stream = stream
+            self.streamlen = buflen
+            stream.extend(sorted(list(self.succeeded) + list(self.failed),
+                                 key=lambda t: t.t_end))
+            self.succeeded.clear()
+            self.failed.clear()
+        try:
+            while True:
+                with self.done:
+                    while (len(stream) == 0) and (self.npending != 0):
+                        if timeout is None:
+                            self.done.wait(1.0)
+                        else:
+                            left = ts + timeout - time.time()
+                            if left <= 0:
+                                return
+                            self.done.wait(left)
+                    if len(stream) == 0:
+                        return
+                    task = stream.popleft()
+                    self.done.notify_all()
+                yield task
+        finally:
+            # give back whatever the consumer did not take
+            with self.done:
+                self.stream = None
+                for task in stream:
+                    if not task.success:
+                        self.failed.append(task)
+                    elif self.keepsucceeded:
+                        self.succeeded.append(task)
+                self.done.notify_all()
+
     def nthreads_working(self):
         count = 0
         for thread in self.threads:
@@ -161,14 +683,663 @@ class Pool(object):
                 count += 1
         return count
 
-    def close(self):
-        for thread in self.threads:
+    def close(self, drain=False, timeout=None, grace=1.0):
+        """Stop the pool.
+
+        With drain, first wait for the queued and running tasks. Then the
+        tasks still queued are cancelled, the running ones are killed, and
+        killed with force after grace seconds, and the runners are joined
+        for grace more seconds. Return after timeout seconds, or without a
+        timeout about 2 * grace seconds after the drain, even if a task
+        ignoring kills keeps its runner.
+        """
+        ts = time.time()
+        if drain:
+            self.wait(timeout)
+        self.closed = True
+        if self.monitor is not None:
+            self.monitor.stop()
+        with self.new:
+            threads = list(self.threads)
+            for thread in threads:
+                thread.closed = True
+            self.new.notify_all()
+            self.notfull.notify_all()
+        self.cancel_queued()
+        for thread in threads:
             thread.close()
+        threads = [t for t in threads
+                   if t.ident is not None and t is not current_thread()]
+        deadline = time.time() + grace
+        if timeout is not None:
+            deadline = min(deadline, ts + timeout)
+        self.join(threads, deadline)
+        for thread in threads:
+            task = thread.curr
+            if thread.is_alive() and (task is not None):
+                self.logger.warn('Task [%s] still runs, kill with force.'
+                                 % (task))
+                try:
+                    task.kill(force=True)
+                except Exception as e:
+                    self.logger.exception(e)
+        deadline = time.time() + grace
+        if timeout is not None:
+            deadline = ts + timeout
+        self.join(threads, deadline)
+        # tasks queued by listeners of the last tasks
+        self.cancel_queued()
+        left = [t for t in threads if t.is_alive()]
+        if len(left) != 0:
+            self.logger.warn('%s runners still alive after close.'
+                             % (len(left)))
+
+    def join(self, threads, deadline):
+        for thread in threads:
+            if deadline is None:
+                thread.join()
+            else:
+                left = deadline - time.time()
+                if left <= 0:
+                    return
+                thread.join(left)
+
+    def cancel_queued(self):
+        while True:
+            with self.new:
+                tasks = []
+                if self.stealing:
+                    for thread in self.threads:
+                        with thread.locallock:
+                            tasks.extend(thread.local)
+                            thread.local.clear()
+                else:
+                    while len(self.torun) != 0:
+                        tasks.append(self.torun.pop())
+                if self.nblocked > 0:
+                    self.notfull.notify_all()
+            if len(tasks) == 0:
+                return
+            for task in tasks:
+                self.cancel(task)
+
+    def cancel(self, task):
+        """Finish a pending task that will not run, as cancelled."""
+        task.t_end = time.time() - self.t_start
+        task.state = Task.FINISHED
+        task.success = False
+        task.errmsg = 'Cancelled by Pool.close().'
+        with self.done:
+            self.cancelled.append(task)
+        self.finish(task, keep=False)
+
+    def retry(self, task):
+        """Queue a failed task again after a backoff if its policy allows.
+
+        Return True if the task will run again.
+        """
+        policy = task.retry
+        if ((policy is None) or self.closed or (task.race is not None) or
+                (task.ntries >= policy.maxtries)):
+            return False
+        delay = policy.delay(task.ntries)
+        self.logger.warn('Task [%s] failed, retry %s in %s sec.'
+                         % (task, task.ntries, delay))
+        task.reset()
+        timer = Timer(delay, self.requeue, [task])
+        timer.daemon = True
+        timer.start()
+        return True
+
+    def straggle(self):
+        """Launch a copy of the tasks that run longer than the percentile.
+
+        Called periodically by the monitor when speculate is set.
+        """
+        with self.done:
+            if len(self.samples) < self.minsamples:
+                return
+            samples = sorted(self.samples)
+        limit = samples[int(self.speculate * (len(samples) - 1))]
+        now = time.time() - self.t_start
+        for thread in self.threads:
+            task = thread.curr
+            if ((task is None) or (task.state != Task.RUNNING) or
+                    (task.race is not None) or
+                    (now - task.t_start <= limit)):
+                continue
+            clone = task.clone()
+            if clone is None:
+                continue
+            # the runner marks the task finished under the same lock, so a
+            # task is raced only while it still runs
+            with self.new:
+                if (thread.curr is not task) or (
+                        task.state != Task.RUNNING):
+                    continue
+                clone.race = task.race = TaskRace(task, clone)
+            self.logger.warn('Task [%s] runs for %s sec, launch a copy.'
+                             % (task, now - task.t_start))
+            with self.done:
+                self.npending += 1
+            self.requeue(clone)
+
+    def resolve(self, task):
+        """Settle a speculative race when one of its tasks finished.
+
+        Return the task to report, the original with the results of the
+        winner, once both copies are finished, otherwise None.
+        """
+        race = task.race
+        loser = None
+        with self.done:
+            race.nleft -= 1
+            if task.success and (race.winner is None):
+                race.winner = task
+                loser = race.other(task)
+            last = (race.nleft == 0)
+        if loser is not None:
+            loser.kill()
+        if not last:
+            with self.done:
+                self.npending -= 1
+                self.done.notify_all()
+            return None
+        if (race.winner is not None) and (race.winner is not race.original):
+            race.original.adopt(race.winner)
+        race.original.race = None
+        return race.original
+
+    def expired(self, task):
+        """Handle a task whose deadline passed before it starts."""
+        self.nexpired += 1
+        task.t_end = time.time() - self.t_start
+        task.state = Task.FINISHED
+        task.success = False
+        task.errmsg = 'Deadline %s passed before start.' % (task.deadline)
+        self.logger.warn('Task [%s] expired.' % (task))
+        self.finish(task, keep=(self.expire == 'fail'))
+
+    def finish(self, task, keep=True):
+        """Record a finished task and notify the listeners."""
+        if task.race is not None:
+            task = self.resolve(task)
+            if task is None:
+                return
+        # listeners go first so that tasks they add keep the pool pending
+        if len(self.listeners) != 0:
+            self.notify('on_finished', task)
+        if task.future is not None:
+            task.future.set_done()
+        if not task.success:
+            if keep:
+                self.logger.error(
+                    'Task [%s] failed at %s. Error message: %s.'
+                    % (task, task.t_end, task.errmsg))
+            done = self.failed
+        else:
+            if self.logtasks:
+                self.logger.info(
+                    'Task [%s] succeeded at %s.' % (task, task.t_end))
+            done = self.succeeded if self.keepsucceeded else None
+        with self.done:
+            if task.t_start >= 0:
+                duration = task.t_end - task.t_start
+                if task.success:
+                    self.samples.append(duration)
+                if self.duration is None:
+                    self.duration = duration
+                else:
+                    self.duration += 0.1 * (duration - self.duration)
+            stream = self.stream
+            if keep and (stream is not None):
+                # bounded buffering: wait for the consumer of as_completed()
+                while (len(stream) >= self.streamlen) and (
+                        self.stream is stream):
+                    self.done.wait(1.0)
+                if self.stream is not stream:
+                    stream = None
+                else:
+                    stream.append(task)
+            if keep and (stream is None) and (done is not None):
+                done.append(task)
+            self.npending -= 1
+            self.done.notify_all()
+
+    def notify(self, event, task):
+        for listener in self.listeners:
+            try:
+                getattr(listener, event)(task)
+            except Exception as e:
+                self.logger.exception(e)
+
+    def add_listener(self, listener):
+        """Add a TaskListener to be notified of task events."""
+        self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener):
+        self.listeners = [l for l in self.listeners if l is not listener]
+
+
+class TaskListener(object):
+    """Receive task events from a pool.
+
+    The callbacks are called in the runner threads, so they should be
+    short and thread safe.
+    """
+    def on_queued(self, task):
+        """Called when a task is put into the queue."""
+        pass
+
+    def on_started(self, task):
+        """Called in the runner thread right before a task runs."""
+        pass
+
+    def on_finished(self, task):
+        """Called after a task finished, failed or expired."""
+        pass
+
+
+class TaskStats(TaskListener):
+    """Collect queue wait, run time and failure rate of finished tasks.
+
+    Times are kept in RollingHist, so memory does not grow with the number
+    of tasks.
+    """
+    def __init__(self):
+        self.wait = RollingHist()
+        self.runtime = RollingHist()
+        self.nfinished = 0
+        self.nfailed = 0
+        self.lock = Lock()
+
+    def on_finished(self, task):
+        with self.lock:
+            self.nfinished += 1
+            if not task.success:
+                self.nfailed += 1
+            if task.t_start >= 0:
+                self.wait.update(task.t_start - task.t_queued)
+                self.runtime.update(task.t_end - task.t_start)
+
+    def failrate(self):
+        with self.lock:
+            if self.nfinished == 0:
+                return 0.0
+            return float(self.nfailed) / self.nfinished
+
+    def summary(self):
+        """Return a dict of the main statistics."""
+        with self.lock:
+            return {
+                'finished' : self.nfinished,
+                'failed' : self.nfailed,
+                'wait_mean' : self.wait.mean(),
+                'wait_p50' : self.wait.percentile(0.5),
+                'wait_p99' : self.wait.percentile(0.99),
+                'runtime_mean' : self.runtime.mean(),
+                'runtime_p50' : self.runtime.percentile(0.5),
+                'runtime_p99' : self.runtime.percentile(0.99),
+            }
+
+
+class TaskTracer(TaskListener):
+    """Record finished tasks as Chrome trace events.
+
+    Each task becomes a complete event on the row of the runner thread that
+    ran it. The trace can be loaded in chrome://tracing or Perfetto.
+
+    init arguments:
+        maxevents: stop recording after this many events.
+    """
+    def __init__(self, maxevents=1000000):
+        self.maxevents = maxevents
+        self.events = []
+        self.pid = os.getpid()
+
+    def on_finished(self, task):
+        if (task.t_start < 0) or (len(self.events) >= self.maxevents):
+            return
+        self.events.append({
+            'name' : str(task),
+            'ph' : 'X',
+            'ts' : task.t_start * 1e6,
+            'dur' : (task.t_end - task.t_start) * 1e6,
+            'pid' : self.pid,
+            'tid' : current_thread().ident,
+            'args' : {'success' : task.success,
+                      'wait' : task.t_start - task.t_queued},
+        })
+
+    def dump(self, writer):
+        """Write the trace as JSON to a file-like object."""
+        json.dump({'traceEvents' : self.events}, writer)
+
+
+class TaskGraph(TaskListener):
+    """Run tasks with dependencies on a pool.
+
+    A task is added to the pool as soon as all its dependencies have
+    succeeded. If a dependency fails, the task and all tasks depending on it
+    are skipped: they finish without running, with success False.
+
+    init arguments:
+        pool: the pool to run the tasks.
+
+    methods:
+        add(): add a task with a list of dependencies already added.
+        start(): start adding ready tasks to the pool.
+        wait(): wait until all the tasks are finished or skipped.
+        critical_path(): the chain of tasks that determined the end time.
+    """
+    def __init__(self, pool):
+        self.pool = pool
+        self.deps = {}
+        self.dependents = {}
+        self.npending = {}
+        self.skipped = []
+        self.nleft = 0
+        self.started = False
+        self.lock = Condition()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def add(self, task, deps=None):
+        """Add a task which runs after all tasks in deps succeeded."""
+        deps = [] if deps is None else list(deps)
+        ready = False
+        with self.lock:
+            if task in self.deps:
+                raise ValueError('Task [%s] already added.' % (task))
+            for dep in deps:
+                if dep not in self.deps:
+                    raise ValueError('Dependency [%s] not added.' % (dep))
+            self.deps[task] = deps
+            self.dependents[task] = []
+            self.nleft += 1
+            npending = 0
+            failed = None
+            for dep in deps:
+                self.dependents[dep].append(task)
+                if dep.state != Task.FINISHED:
+                    npending += 1
+                elif not dep.success:
+                    failed = dep
+            self.npending[task] = npending
+            if failed is not None:
+                self._skip(task, failed)
+            elif self.started and npending == 0:
+                ready = True
+        if ready:
+            self.pool.add(task)
+
+    def start(self):
+        """Add the tasks without pending dependencies to the pool."""
+        with self.lock:
+            self.started = True
+            ready = [task for task, npending in self.npending.iteritems()
+                     if npending == 0 and task.state == Task.TORUN]
+        self.pool.add_listener(self)
+        for task in ready:
+            self.pool.add(task)
+
+    def wait(self, timeout=None):
+        """Wait until all the tasks are finished or timeout."""
+        ts = time.time()
+        with self.lock:
+            while self.nleft != 0:
+                if timeout is None:
+                    self.lock.wait(1.0)
+                else:
+                    left = ts + timeout - time.time()
+                    if left <= 0:
+                        break
+                    self.lock.wait(left)
+            return self.nleft == 0
+
+    def on_finished(self, task):
+        ready = []
+        with self.lock:
+            if task not in self.deps:
+                return
+            self.nleft -= 1
+            for child in self.dependents[task]:
+                if child.state != Task.TORUN:
+                    continue
+                if not task.success:
+                    self._skip(child, task)
+                    continue
+                self.npending[child] -= 1
+                if self.npending[child] == 0:
+                    ready.append(child)
+            if self.nleft == 0:
+                self.lock.notify_all()
+        for child in ready:
+            self.pool.add(child)
+
+    def _skip(self, task, failed):
+        # skip the task and all the tasks depending on it
+        stack = [task]
+        while len(stack) != 0:
+            curr = stack.pop()
+            if curr.state != Task.TORUN:
+                continue
+            curr.state = Task.FINISHED
+            curr.success = False
+            curr.errmsg = 'Skipped since dependency [%s] failed.' % (failed)
+            self.skipped.append(curr)
+            self.nleft -= 1
+            self.logger.warn('Task [%s] skipped.' % (curr))
+            stack.extend(self.dependents[curr])
+        if self.nleft == 0:
+            self.lock.notify_all()
+
+    def critical_path(self):
+        """Return the chain of tasks leading to the last finished one.
+
+        Starting from the task with the latest t_end, repeatedly go to the
+        dependency that finished last. Tasks not run are ignored.
+        """
+        with self.lock:
+            ran = [task for task in self.deps if task.t_end >= 0]
+            if len(ran) == 0:
+                return []
+            curr = max(ran, key=lambda t: t.t_end)
+            path = [curr]
+            while True:
+                deps = [dep for dep in self.deps[curr] if dep.t_end >= 0]
+                if len(deps) == 0:
+                    break
+                curr = max(deps, key=lambda t: t.t_end)
+                path.append(curr)
+            path.reverse()
+            return path
+
+
+class TaskJournal(TaskListener):
+    """An append-only log of finished tasks, to resume an interrupted run.
+
+    Each finished task with a taskid appends a SerializeTool tuple
+        (taskid, success, errmsg, t_start, t_end)
+    to the file. Records are buffered and written by a background thread
+    every syncbatch records or syncinterval seconds, with one fsync per
+    write, so the runners never wait for the disk. On open, the records of
+    the previous runs are loaded, and a record torn by a crash is cut off.
+
+    init arguments:
+        path: the journal file.
+        syncbatch: number of records that triggers a write.
+        syncinterval: max seconds a record stays in memory.
+
+    methods:
+        succeeded(): the record of a task that succeeded before, or None.
+        flush(): write the buffered records now.
+        close(): flush and close the file.
+    """
+    def __init__(self, path, syncbatch=1000, syncinterval=1.0):
+        self.path = path
+        self.syncbatch = syncbatch
+        self.syncinterval = syncinterval
+        self.sertool = SerializeTool()
+        self.records = {}
+        self.buf = []
+        self.cond = Condition()
+        self.closed = False
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.load()
+        self.fh = open(path, 'ab')
+        self.writer = Thread(target=self.writeloop)
+        self.writer.daemon = True
+        self.writer.start()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as fh:
+            data = fh.read()
+        reader = StringIO(data)
+        pos = 0
+        while pos < len(data):
+            try:
+                record = self.sertool.deserialize(reader)
+            except (ValueError, struct.error):
+                break
+            if (not isinstance(record, tuple)) or (len(record) != 5):
+                break
+            self.records[record[0]] = record
+            pos = reader.tell()
+        if pos < len(data):
+            self.logger.warn('Cut torn record at %s of %s.'
+                             % (pos, self.path))
+            with open(self.path, 'r+b') as fh:
+                fh.truncate(pos)
+
+    def succeeded(self, taskid):
+        if taskid is None:
+            return None
+        record = self.records.get(taskid)
+        if (record is None) or (not record[1]):
+            return None
+        return record
+
+    def on_finished(self, task):
+        if (task.taskid is None) or (task.state != Task.FINISHED):
+            return
+        if self.succeeded(task.taskid) is not None:
+            return
+        errmsg = '' if task.errmsg is None else str(task.errmsg)
+        record = (task.taskid, int(task.success), errmsg,
+                  float(task.t_start), float(task.t_end))
+        with self.cond:
+            self.records[task.taskid] = record
+            self.buf.append(record)
+            if len(self.buf) >= self.syncbatch:
+                self.cond.notify()
+
+    def writeloop(self):
+        while True:
+            with self.cond:
+                if (len(self.buf) < self.syncbatch) and (not self.closed):
+                    self.cond.wait(self.syncinterval)
+                closed = self.closed
+            self.flush()
+            if closed:
+                break
+
+    def flush(self):
+        with self.cond:
+            records = self.buf
+            self.buf = []
+        if len(records) == 0:
+            return
+        writer = StringIO()
+        for record in records:
+            self.sertool.clear_visited()
+            self.sertool.serialize(record, writer)
+        self.fh.write(writer.getvalue())
+        self.fh.flush()
+        os.fsync(self.fh.fileno())
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.writer.join()
+        self.fh.close()
+
+
+class TaskQueue(object):
+    """A first-in-first-out task queue."""
+    def __init__(self):
+        self.tasks = deque()
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def push(self, task):
+        self.tasks.append(task)
+
+    def pop(self):
+        """Pop the next task. Raise IndexError if empty."""
+        return self.tasks.popleft()
+
+
+class PriorityTaskQueue(object):
+    """A heap based task queue.
+
+    Tasks with smaller Task.priority run first, ties in queuing order. With
+    aging, the effective priority of a waiting task decreases by `aging`
+    every second so that low priority tasks are not starved. Since all
+    tasks age at the same rate, the order only depends on
+        priority + aging * queued_time
+    which is fixed at push time and kept as the heap key.
+    """
+    def __init__(self, aging=0.0):
+        self.aging = aging
+        self.t_start = time.time()
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, task):
+        key = task.priority
+        if self.aging:
+            key += self.aging * (time.time() - self.t_start)
+        heapq.heappush(self.heap, (key, next(self.counter), task))
+
+    def pop(self):
+        """Pop the next task. Raise IndexError if empty."""
+        return heapq.heappop(self.heap)[2]
+
 
 class Task(object):
+    """A unit of work run by the pool.
+
+    init arguments:
+        priority: smaller value runs first with PriorityTaskQueue.
+        deadline: absolute time (as time.time()) before which the task
+            must start, otherwise it is expired without running.
+        retry: a RetryPolicy for running the task again if it fails.
+        taskid: a str or int identifying the task across runs, for
+            TaskJournal.
+
+    Subclasses that can run again override reset() for retries, and
+    clone() for speculative copies, with RESULTS naming the attributes
+    that adopt() takes from a winning copy.
+    """
     TORUN, RUNNING, FINISHED = range(3)
-    def __init__(self):
+    RESULTS = ('success', 'errmsg', 't_start', 't_end')
+    def __init__(self, priority=0, deadline=None, retry=None, taskid=None):
         self.state = Task.TORUN
+        self.taskid = taskid
+        self.future = None
+        self.retry = retry
+        self.ntries = 0
+        self.race = None
+        self.t_queued = -1
+        self.priority = priority
+        self.deadline = deadline
         self.t_start = -1
         self.t_end = -1
         self.success = False
@@ -178,9 +1349,148 @@ class Task(object):
     def run(self):
         pass
 
-    def kill(self):
+    def kill(self, force=False):
+        """Ask the running task to stop. force is set when it did not stop
+        in time after a first kill."""
         pass
 
+    def reset(self):
+        """Prepare the task to run again."""
+        self.state = Task.TORUN
+        self.t_start = -1
+        self.t_end = -1
+        self.success = False
+        self.errmsg = None
+
+    def clone(self):
+        """Return a fresh copy to run at the same time, None if unable.
+        The copy keeps the taskid and priority."""
+        return None
+
+    def adopt(self, other):
+        """Take the results of a copy of this task that won a race."""
+        for key in self.RESULTS:
+            if hasattr(other, key):
+                setattr(self, key, getattr(other, key))
+
+
+class FuncTask(Task):
+    """Run a function with arguments, failing if it raises."""
+    RESULTS = Task.RESULTS + ('result',)
+
+    def __init__(self, function, *args, **kwargs):
+        super(FuncTask, self).__init__()
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.result = None
+
+    def __str__(self):
+        return getattr(self.function, '__name__', str(self.function))
+
+    def run(self):
+        try:
+            self.result = self.function(*self.args, **self.kwargs)
+            self.success = True
+        except Exception as e:
+            self.errmsg = '%s: %s' % (e.__class__.__name__, e)
+
+
+class RetryPolicy(object):
+    """How a failed task is run again.
+
+    init arguments:
+        maxtries: max number of runs, the first one included.
+        backoff: seconds to wait before the first retry.
+        factor: multiplier of the backoff for each further retry.
+        maxbackoff: upper bound of the backoff.
+    """
+    def __init__(self, maxtries=3, backoff=1.0, factor=2.0, maxbackoff=60.0):
+        self.maxtries = maxtries
+        self.backoff = backoff
+        self.factor = factor
+        self.maxbackoff = maxbackoff
+
+    def delay(self, ntries):
+        """The backoff after the ntries-th run failed."""
+        return min(self.maxbackoff,
+                   self.backoff * self.factor ** (ntries - 1))
+
+
+class TaskRace(object):
+    """A task and its speculative copy, the first to succeed wins."""
+    def __init__(self, original, copy):
+        self.original = original
+        self.copy = copy
+        self.winner = None
+        self.nleft = 2
+
+    def other(self, task):
+        return self.copy if task is self.original else self.original
+
+
+class TaskFuture(object):
+    """A handle to a submitted task.
+
+    methods:
+        done(): whether the task finished.
+        result(): wait for the task and return it. Raise TaskFuture.Failed
+            if it failed and TaskFuture.Timeout on timeout.
+        add_done_callback(): call fn(future) when the task finishes, or
+            right away if it already did.
+    """
+    class Timeout(Exception):
+        pass
+
+    class Failed(Exception):
+        def __init__(self, task):
+            super(TaskFuture.Failed, self).__init__(task.errmsg)
+            self.task = task
+
+    def __init__(self, task):
+        self.task = task
+        self.finished = False
+        self.callbacks = []
+        self.cond = Condition()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def done(self):
+        return self.finished
+
+    def result(self, timeout=None):
+        ts = time.time()
+        with self.cond:
+            while not self.finished:
+                if timeout is None:
+                    self.cond.wait(1.0)
+                else:
+                    left = ts + timeout - time.time()
+                    if left <= 0:
+                        raise TaskFuture.Timeout
+                    self.cond.wait(left)
+        if not self.task.success:
+            raise TaskFuture.Failed(self.task)
+        return self.task
+
+    def add_done_callback(self, fn):
+        with self.cond:
+            if not self.finished:
+                self.callbacks.append(fn)
+                return
+        fn(self)
+
+    def set_done(self):
+        with self.cond:
+            self.finished = True
+            callbacks = self.callbacks
+            self.callbacks = []
+            self.cond.notify_all()
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                self.logger.exception(e)
+
 
 class TaskRunner(Thread):
     def __init__(self, pool):
@@ -189,24 +1499,38 @@ class TaskRunner(Thread):
         self.curr = None
         self.closed = False
         self.check_interval = 0.1
+        self.local = deque()
+        self.locallock = Lock()
         self.logger = logging.getLogger(self.__class__.__name__)
 
     def run(self):
         while not self.closed:
             try:
-                with self.pool.new:
-                    while (self.pool.qlen() == 0) and (not self.closed):
-                        self.pool.new.wait(1.0)
-                    if self.closed:
-                        break
-                    self.curr = self.pool.torun.popleft()
+                if not self.next_task():
+                    break
+                if ((self.curr.deadline is not None) and
+                        (time.time() > self.curr.deadline)):
+                    self.pool.expired(self.curr)
+                    self.curr = None
+                    continue
+                race = self.curr.race
+                if (race is not None) and (race.winner is not None):
+                    # the other copy already won, no need to run
+                    self.curr.state = Task.FINISHED
+                    self.pool.finish(self.curr)
+                    self.curr = None
+                    continue
                 if self.curr.state != Task.TORUN:
                     raise ValueError('Task state not Task.TORUN: state=%s'
                                      % (self.curr.state))
                 self.curr.t_start = time.time() - self.pool.t_start
                 self.curr.state = Task.RUNNING
-                self.logger.info('Task [%s] starts at %s.'
-                                 % (self.curr, self.curr.t_start))
+                self.curr.ntries += 1
+                if self.pool.logtasks:
+                    self.logger.info('Task [%s] starts at %s.'
+                                     % (self.curr, self.curr.t_start))
+                if len(self.pool.listeners) != 0:
+                    self.pool.notify('on_started', self.curr)
                 self.curr.run()
             except Exception as e:
                 self.logger.exception(e)
@@ -217,24 +1541,84 @@ class TaskRunner(Thread):
                             'Task state not Task.RUNNING: state=%s'
                             % (self.curr.state))
                     self.curr.t_end = time.time() - self.pool.t_start
-                    self.curr.state = Task.FINISHED
-                    if not self.curr.success:
-                        self.logger.error(
-                            'Task [%s] failed at %s. Error message: %s.'
-                            % (self.curr, self.curr.t_end,
-                               self.curr.errmsg))
-                        with self.pool.done:
-                            self.pool.failed.append(self.curr)
-                            self.pool.done.notify()
-                    else:
-                        self.logger.info(
-                            'Task [%s] succeeded at %s.'
-                            % (self.curr, self.curr.t_end))
-                        with self.pool.done:
-                            self.pool.succeeded.append(self.curr)
-                            self.pool.done.notify()
+                    with self.pool.new:
+                        self.curr.state = Task.FINISHED
+                    if self.curr.success or not self.pool.retry(self.curr):
+                        self.pool.finish(self.curr)
                 self.curr = None
 
+    def next_task(self):
+        """Take the next task into self.curr.
+
+        Return False if the runner is closed before a task is available.
+        """
+        if not self.pool.stealing:
+            with self.pool.new:
+                idle_since = time.time()
+                while (self.pool.qlen() == 0) and (not self.closed):
+                    if self.pool.retire(self, idle_since):
+                        return False
+                    self.pool.new.wait(self.pool.idlewait())
+                if self.closed:
+                    return False
+                self.curr = self.pool.torun.pop()
+                if self.pool.nblocked > 0:
+                    self.pool.notfull.notify_all()
+            return True
+        self.curr = self.take()
+        if self.curr is None:
+            # An idle runner registers itself before looking at the queues
+            # again, and Pool.add_many() fills the queues before looking at
+            # nidle. So either the runner finds the task or the producer
+            # sees the idle runner and notifies it.
+            with self.pool.new:
+                self.pool.nidle += 1
+                idle_since = time.time()
+                try:
+                    while True:
+                        self.curr = self.take()
+                        if self.curr is not None:
+                            break
+                        if self.closed:
+                            return False
+                        if self.pool.retire(self, idle_since):
+                            return False
+                        self.pool.new.wait(self.pool.idlewait())
+                finally:
+                    self.pool.nidle -= 1
+        # the same ordering with Pool.room() for blocked producers
+        if self.pool.nblocked > 0:
+            with self.pool.new:
+                self.pool.notfull.notify_all()
+        return True
+
+    def take(self):
+        """Pop a task from the local queue, or steal from another runner.
+
+        The owner pops from the head of its queue while a thief takes half
+        of the tasks from the tail of the victim's queue.
+        """
+        with self.locallock:
+            if len(self.local) != 0:
+                return self.local.popleft()
+        threads = self.pool.threads
+        nthreads = len(threads)
+        start = random.randint(0, nthreads - 1)
+        for i in range(nthreads):
+            victim = threads[(start + i) % nthreads]
+            if (victim is self) or (len(victim.local) == 0):
+                continue
+            with victim.locallock:
+                nsteal = (len(victim.local) + 1) / 2
+                stolen = [victim.local.pop() for j in range(nsteal)]
+            if len(stolen) == 0:
+                continue
+            stolen.reverse()
+            with self.locallock:
+                self.local.extend(stolen[1:])
+            return stolen[0]
+        return None
+
     def close(self):
         if self.curr is not None:
             self.curr.kill()
@@ -244,17 +1628,166 @@ class TaskRunner(Thread):
         return self.curr is not None
 
 
+class ResourceLimits(object):
+    """Limits on the resources of a child process.
+
+    The rlimits, nice and ionice levels are set in the child before exec.
+    With cgroup, each command gets its own cgroup v2 leaf under that
+    directory, holding the memory and cpus limits for the whole process
+    tree; the rlimits are used instead when the cgroup is not writable.
+
+    init arguments:
+        cpu: max cpu seconds (RLIMIT_CPU).
+        memory: max bytes of memory (memory.max, or RLIMIT_AS).
+        nofile: max open files (RLIMIT_NOFILE).
+        nice: increment of the nice level.
+        ioclass: ionice class, 1 realtime, 2 best effort, 3 idle.
+        iolevel: ionice level in the class, 0 (high) to 7 (low).
+        cgroup: a cgroup v2 directory with the memory and cpu controllers
+            enabled for its children.
+        cpus: max number of cpus used (cpu.max), cgroup only.
+
+    methods:
+        enter(): make the cgroup leaf of a command and return its path.
+        preexec(): a function that applies the limits in the child.
+        exit(): remove a cgroup leaf.
+    """
+    # ioprio_set syscall numbers, not exposed by the os module
+    IOPRIO_SET = {'x86_64' : 251, 'i386' : 289, 'i686' : 289,
+                  'aarch64' : 30, 'armv7l' : 314}
+    CPU_PERIOD = 100000
+    # (libc syscall, ioprio_set number), resolved in the parent
+    _ioprio_set = None
+
+    def __init__(self, cpu=None, memory=None, nofile=None, nice=None,
+                 ioclass=None, iolevel=4, cgroup=None, cpus=None):
+        self.cpu = cpu
+        self.memory = memory
+        self.nofile = nofile
+        self.nice = nice
+        self.ioclass = ioclass
+        self.iolevel = iolevel
+        self.cgroup = cgroup
+        self.cpus = cpus
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def enter(self):
+        """Return the path of a new cgroup leaf, or None."""
+        if self.cgroup is None:
+            return None
+        if not os.path.exists(os.path.join(self.cgroup,
+                                           'cgroup.controllers')):
+            self.logger.warn('No cgroup v2 at %s.' % (self.cgroup))
+            return None
+        leaf = os.path.join(self.cgroup, 'pyutil_%s' % (uuid.uuid4().hex))
+        try:
+            os.mkdir(leaf)
+            if self.memory is not None:
+                self.write(leaf, 'memory.max', '%d' % (self.memory))
+            if self.cpus is not None:
+                self.write(leaf, 'cpu.max', '%d %d' % (
+                    self.cpus * ResourceLimits.CPU_PERIOD,
+                    ResourceLimits.CPU_PERIOD))
+        except (IOError, OSError) as e:
+            self.logger.warn('Cannot set cgroup %s: %s.' % (leaf, e))
+            self.exit(leaf)
+            return None
+        return leaf
+
+    def write(self, leaf, name, value):
+        with open(os.path.join(leaf, name), 'w') as fh:
+            fh.write(value)
+
+    def exit(self, leaf):
+        if leaf is None:
+            return
+        try:
+            os.rmdir(leaf)
+        except OSError as e:
+            self.logger.warn('Cannot remove cgroup %s: %s.' % (leaf, e))
+
+    def preexec(self, leaf=None):
+        """The preexec_fn of a child in cgroup leaf."""
+        if self.ioclass is not None:
+            # the child of a threaded process must not load libraries
+            ResourceLimits.resolve()
+        def apply():
+            if leaf is not None:
+                self.write(leaf, 'cgroup.procs', '0')
+            elif self.memory is not None:
+                self.setrlimit(resource.RLIMIT_AS, self.memory)
+            if self.cpu is not None:
+                self.setrlimit(resource.RLIMIT_CPU, self.cpu)
+            if self.nofile is not None:
+                self.setrlimit(resource.RLIMIT_NOFILE, self.nofile)
+            if self.nice is not None:
+                os.nice(self.nice)
+            if self.ioclass is not None:
+                self.ionice()
+        return apply
+
+    def setrlimit(self, which, value):
+        # the hard limit can only go down
+        hard = resource.getrlimit(which)[1]
+        if (hard != resource.RLIM_INFINITY) and (value > hard):
+            value = hard
+        resource.setrlimit(which, (value, hard))
+
+    @classmethod
+    def resolve(cls):
+        if cls._ioprio_set is None:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                               use_errno=True)
+            cls._ioprio_set = (libc.syscall,
+                               cls.IOPRIO_SET.get(platform.machine()))
+        return cls._ioprio_set
+
+    def ionice(self):
+        syscall, nr = ResourceLimits.resolve()
+        if nr is None:
+            return
+        # IOPRIO_WHO_PROCESS, pid 0 is the caller
+        prio = (self.ioclass << 13) | self.iolevel
+        if syscall(nr, 1, 0, prio) != 0:
+            raise OSError(ctypes.get_errno(), 'ioprio_set failed.')
+
+
 class OSCmd(Task):
-    def __init__(self, cmd, out_writer=None, timeout=None):
+    """A command run in a child process.
+
+    init arguments:
+        cmd: the command line.
+        out_writer: a std writer for the output, in memory if None.
+        timeout: seconds after which the command is killed.
+        limits: a ResourceLimits for the child.
+
+    kill() sends SIGTERM, and SIGKILL if the command is still running
+    killgrace seconds later or with force.
+
+    The resource usage of the child is kept in rusage, with the cpu seconds
+    (user and system) in cputime and the max resident KB in maxrss.
+    """
+    RESULTS = Task.RESULTS + ('writer', 'retcode', 'rusage', 'cputime',
+                              'maxrss')
+
+    def __init__(self, cmd, out_writer=None, timeout=None, limits=None):
         super(OSCmd, self).__init__()
         self.cmd = cmd
+        self.out_writer = out_writer
         self.writer = out_writer
         self.timeout = timeout
+        self.limits = limits
+        self.leaf = None
         self.proc = None
         self.check_interval = 0.1
         self.killed = False
+        self.killgrace = 2.0
+        self.t_killed = None
         self.start_time = -1
         self.retcode = None
+        self.rusage = None
+        self.cputime = None
+        self.maxrss = None
         self.logger = logging.getLogger(self.__class__.__name__)
 
     def __str__(self):
@@ -263,7 +1796,7 @@ class OSCmd(Task):
     def run(self):
         try:
             self.launch()
-            while self.wait():
+            while (self.proc is not None) and self.wait():
                 time.sleep(self.check_interval)
         finally:
             if self.proc is not None:
@@ -271,6 +1804,11 @@ class OSCmd(Task):
                     self.proc.kill()
                 except:
                     pass
+                if self.proc.returncode is None:
+                    self.reap(0)
+            if self.limits is not None:
+                self.limits.exit(self.leaf)
+                self.leaf = None
             if self.writer is not None:
                 try:
                     self.writer.close()
@@ -280,18 +1818,43 @@ class OSCmd(Task):
     def launch(self):
         if self.killed:
             return
+        preexec = None
+        if self.limits is not None:
+            self.leaf = self.limits.enter()
+            preexec = self.limits.preexec(self.leaf)
         if self.writer is None:
             self.proc = subprocess.Popen(shlex.split(self.cmd),
                                          stdout=subprocess.PIPE,
-                                         stderr=subprocess.PIPE)
+                                         stderr=subprocess.PIPE,
+                                         preexec_fn=preexec)
             self.writer = StdPipeWriter(
                 self.proc, NLinesStdStringWriter(100, 50))
         else:
             self.proc = subprocess.Popen(shlex.split(self.cmd),
                                          stdout=self.writer.stdout(),
-                                         stderr=self.writer.stderr())
+                                         stderr=self.writer.stderr(),
+                                         preexec_fn=preexec)
         self.start_time = time.time()
 
+    def reap(self, flags=os.WNOHANG):
+        """Collect the exit code and rusage of the child, with wait4 in
+        place of Popen.poll() that drops the rusage."""
+        try:
+            pid, status, rusage = os.wait4(self.proc.pid, flags)
+        except OSError:
+            # already collected
+            return self.proc.poll()
+        if pid == 0:
+            return None
+        if os.WIFSIGNALED(status):
+            self.proc.returncode = -os.WTERMSIG(status)
+        else:
+            self.proc.returncode = os.WEXITSTATUS(status)
+        self.rusage = rusage
+        self.cputime = rusage.ru_utime + rusage.ru_stime
+        self.maxrss = rusage.ru_maxrss
+        return self.proc.returncode
+
     def wait(self):
         # check timeout
         if self.timeout is not None:
@@ -301,9 +1864,12 @@ class OSCmd(Task):
                     'Command [%s] time out (%s sec). Kill.'
                     % (self.cmd, curr))
                 self.proc.kill()
-                self.proc.wait()
+                self.reap(0)
+        if ((self.t_killed is not None) and
+                (time.time() - self.t_killed > self.killgrace)):
+            self.kill(force=True)
         # check execution
-        self.retcode = self.proc.poll()
+        self.retcode = self.reap()
         if self.retcode is None:
             return True
         if self.retcode != 0:
@@ -318,9 +1884,422 @@ class OSCmd(Task):
             self.success = True
         return False
 
-    def kill(self):
-        if self.proc is not None:
+    def kill(self, force=False):
+        self.killed = True
+        if self.t_killed is None:
+            self.t_killed = time.time()
+        proc = self.proc
+        if (proc is not None) and (proc.returncode is None):
             try:
-                self.proc.kill()
-            except:
+                proc.send_signal(signal.SIGKILL if force else signal.SIGTERM)
+            except OSError:
                 pass
+
+    def reset(self):
+        """Prepare to run again. A given out_writer must accept reopening."""
+        super(OSCmd, self).reset()
+        self.writer = self.out_writer
+        self.proc = None
+        self.killed = False
+        self.t_killed = None
+        self.start_time = -1
+        self.retcode = None
+        self.rusage = None
+        self.cputime = None
+        self.maxrss = None
+
+    def clone(self):
+        """A copy of the command with its own output pipes."""
+        copy = OSCmd(self.cmd, None, self.timeout, self.limits)
+        copy.taskid = self.taskid
+        copy.priority = self.priority
+        return copy
+
+
+class ShellWorker(object):
+    """A long lived shell that runs commands fed over a pipe.
+
+    The fork and exec of the shell is paid once instead of once per command.
+    Each command is quoted and eval'ed in a subshell with stdin from
+    /dev/null, so it can neither change the worker state (cd, exit) nor eat
+    the following commands, and a syntax error only fails the command. Its
+    output ends with a random marker on both stdout and
+    stderr, the stdout one carrying the exit status.
+
+    methods:
+        run(): run a command and write its output to a std writer. On a
+            timeout or an error the worker is killed, its pipes being out
+            of sync.
+        kill(): kill the worker and the command it is running.
+        close(): stop the worker.
+    """
+    def __init__(self, shell='/bin/sh'):
+        self.shell = shell
+        self.proc = None
+        self.marker = '__pyutil_%s__' % (uuid.uuid4().hex)
+        self.ncmds = 0
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def start(self):
+        self.proc = subprocess.Popen([self.shell], stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.PIPE,
+                                     preexec_fn=os.setsid)
+
+    def alive(self):
+        return (self.proc is not None) and (self.proc.poll() is None)
+
+    def run(self, cmd, writer, timeout=None):
+        """Run cmd and return its exit code, or None on timeout.
+
+        The output goes to writer.stdout() and writer.stderr().
+        """
+        if not self.alive():
+            self.start()
+        self.ncmds += 1
+        try:
+            return self.communicate(cmd, writer, timeout)
+        except BaseException:
+            self.kill()
+            raise
+
+    def communicate(self, cmd, writer, timeout):
+        self.proc.stdin.write(
+            '( eval %s ) </dev/null\n'
+            'printf \'\\n%%s %%d\\n\' %s $?\n'
+            'printf \'\\n%%s\\n\' %s >&2\n'
+            % (pipes.quote(cmd), self.marker, self.marker))
+        self.proc.stdin.flush()
+        outfd = self.proc.stdout.fileno()
+        errfd = self.proc.stderr.fileno()
+        bufs = {outfd : '', errfd : ''}
+        writers = {outfd : writer.stdout(), errfd : writer.stderr()}
+        ends = {}
+        ts = time.time()
+        while len(ends) != 2:
+            wait = None
+            if timeout is not None:
+                wait = ts + timeout - time.time()
+                if wait <= 0:
+                    self.logger.warn('Command [%s] time out (%s sec). Kill.'
+                                     % (cmd, timeout))
+                    self.kill()
+                    return None
+            fds = [fd for fd in bufs if fd not in ends]
+            ready = select.select(fds, [], [], wait)[0]
+            for fd in ready:
+                data = os.read(fd, 65536)
+                if data == '':
+                    raise EOFError('Shell worker exited unexpectedly.')
+                bufs[fd] = self.frame(bufs[fd] + data, writers[fd], fd,
+                                      ends)
+        retcode = int(ends[outfd])
+        return retcode
+
+    def frame(self, buf, writer, fd, ends):
+        # write the output before the marker, keep a tail that may be the
+        # start of a marker split between two reads
+        mark = '\n' + self.marker
+        pos = buf.find(mark)
+        if pos < 0:
+            keep = len(mark) + 16
+            if len(buf) > keep:
+                writer.write(buf[:-keep])
+                buf = buf[-keep:]
+            return buf
+        eol = buf.find('\n', pos + len(mark))
+        if eol < 0:
+            return buf
+        writer.write(buf[:pos])
+        ends[fd] = buf[pos + len(mark) : eol].strip()
+        return buf[eol + 1:]
+
+    def kill(self):
+        if self.proc is None:
+            return
+        try:
+            os.killpg(self.proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.proc.wait()
+        self.proc = None
+
+    def close(self):
+        if self.proc is None:
+            return
+        try:
+            self.proc.stdin.close()
+            self.proc.wait()
+        except (IOError, OSError):
+            self.kill()
+        self.proc = None
+
+
+class ShellWorkerPool(object):
+    """A fixed set of ShellWorkers shared by OSCmdBatch tasks.
+
+    Workers are started on first use and reused, so the process startup is
+    paid once per worker.
+    """
+    def __init__(self, nworkers, shell='/bin/sh'):
+        self.idle = [ShellWorker(shell) for i in range(nworkers)]
+        self.workers = list(self.idle)
+        self.cond = Condition()
+
+    def acquire(self):
+        with self.cond:
+            while len(self.idle) == 0:
+                self.cond.wait(1.0)
+            return self.idle.pop()
+
+    def release(self, worker):
+        with self.cond:
+            self.idle.append(worker)
+            self.cond.notify()
+
+    def discard(self, worker):
+        """Kill a worker left in an unknown state and replace it."""
+        worker.kill()
+        with self.cond:
+            self.workers.remove(worker)
+            fresh = ShellWorker(worker.shell)
+            self.workers.append(fresh)
+            self.idle.append(fresh)
+            self.cond.notify()
+
+    def close(self):
+        for worker in self.workers:
+            worker.close()
+
+
+class OSCmdBatch(Task):
+    """Run a list of short commands one after another in one shell.
+
+    init arguments:
+        cmds: the list of commands.
+        workers: a ShellWorkerPool to borrow a worker from. If None, a
+            worker is started for this batch only.
+        timeout: the timeout of each command.
+
+    After running, retcodes[i] and writers[i] hold the exit code and the
+    last lines of output of cmds[i]. The batch succeeds if all commands
+    exit with 0; a timed out command has retcode None.
+    """
+    def __init__(self, cmds, workers=None, timeout=None):
+        super(OSCmdBatch, self).__init__()
+        self.cmds = list(cmds)
+        self.workers = workers
+        self.timeout = timeout
+        self.retcodes = []
+        self.writers = []
+        self.worker = None
+        self.killed = False
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    def __str__(self):
+        return 'batch of %s commands' % (len(self.cmds))
+
+    def run(self):
+        if self.workers is None:
+            self.worker = ShellWorker()
+        else:
+            self.worker = self.workers.acquire()
+        # a worker that timed out or failed is not reused
+        broken = True
+        try:
+            for cmd in self.cmds:
+                if self.killed:
+                    break
+                writer = NLinesStdStringWriter(100, 50)
+                try:
+                    retcode = self.worker.run(cmd, writer, self.timeout)
+                except EOFError:
+                    if self.killed:
+                        break
+                    raise
+                writer.close()
+                self.retcodes.append(retcode)
+                self.writers.append(writer)
+                if (retcode != 0) and (self.errmsg is None):
+                    self.errmsg = (
+                        'Command [%s] exit with code %s.\n'
+                        '\tSTDOUT:\n%s\n\tSTDERR:\n%s\n'
+                        % (cmd, retcode, writer.stdout().tail(50),
+                           writer.stderr().tail(50)))
+            self.success = ((not self.killed) and
+                            (len(self.retcodes) == len(self.cmds)) and
+                            all([r == 0 for r in self.retcodes]))
+            broken = self.killed or (None in self.retcodes)
+        finally:
+            if self.workers is None:
+                self.worker.close()
+            elif broken:
+                self.workers.discard(self.worker)
+            else:
+                self.workers.release(self.worker)
+            self.worker = None
+
+    def kill(self, force=False):
+        self.killed = True
+        worker = self.worker
+        if worker is not None:
+            worker.kill()
+
+
+class FanOut(TaskListener):
+    """Run a command on every leaf of a topology scope with concurrency caps.
+
+    Commands are released to the pool so that at most maxperrack of them
+    run at once in each rack (the parent of the leaves) and maxtotal
+    overall, to avoid saturating the links of a rack. Commands that do not
+    fit in the pool queue stay pending until there is room.
+
+    init arguments:
+        pool: the pool to run the commands.
+        topology: a pyutil.net.Topology.
+        template: the command, formatted with the %(name)s, %(ip)s and
+            %(fullname)s of each leaf.
+        transport: a function (node, cmd) returning the Task that runs cmd
+            for node, FanOut.local by default, FanOut.ssh for remote nodes.
+        maxperrack: max number of running commands per rack.
+        maxtotal: max number of running commands, unbounded if None.
+
+    methods:
+        start(): start running the commands on the leaves under scope.
+        wait(): wait until all the commands are finished or timeout.
+    After start(), tasks maps each leaf to its task.
+    """
+    def __init__(self, pool, topology, template, transport=None,
+                 maxperrack=1, maxtotal=None):
+        self.pool = pool
+        self.topology = topology
+        self.template = template
+        self.transport = FanOut.local if transport is None else transport
+        self.maxperrack = maxperrack
+        self.maxtotal = maxtotal
+        self.tasks = {}
+        self.racks = {}
+        self.pending = {}
+        self.running = {}
+        self.nrunning = 0
+        self.nleft = 0
+        # set when the pool queue was full, so that any finished task or
+        # wait() retries the release
+        self.starved = False
+        self.cond = Condition()
+        self.logger = logging.getLogger(self.__class__.__name__)
+
+    @classmethod
+    def local(cls, node, cmd):
+        """Run cmd on this host with sh -c, a stand-in for a remote node."""
+        return OSCmd('sh -c %s' % (pipes.quote(cmd)))
+
+    @classmethod
+    def ssh(cls, node, cmd):
+        """Run cmd on the node's ip through ssh."""
+        return OSCmd('ssh -o BatchMode=yes %s %s'
+                     % (node.ip, pipes.quote(cmd)))
+
+    def start(self, scope=None):
+        with self.cond:
+            for leaf in self.topology.getleaves(scope):
+                cmd = self.template % {'name' : leaf.name, 'ip' : leaf.ip,
+                                       'fullname' : leaf.fullname()}
+                task = self.transport(leaf, cmd)
+                rack = leaf.parent
+                self.tasks[leaf] = task
+                self.racks[task] = rack
+                self.pending.setdefault(rack, deque()).append(task)
+                self.running.setdefault(rack, 0)
+                self.nleft += 1
+        self.pool.add_listener(self)
+        self.release()
+
+    def release(self):
+        # take the ready tasks round robin over the racks
+        ready = []
+        with self.cond:
+            self.starved = False
+            progress = True
+            while progress:
+                progress = False
+                for rack, pending in self.pending.iteritems():
+                    if ((self.maxtotal is not None) and
+                            (self.nrunning >= self.maxtotal)):
+                        break
+                    if ((len(pending) == 0) or
+                            (self.running[rack] >= self.maxperrack)):
+                        continue
+                    ready.append(pending.popleft())
+                    self.running[rack] += 1
+                    self.nrunning += 1
+                    progress = True
+        if len(ready) == 0:
+            return
+        try:
+            self.pool.add_many(ready)
+            return
+        except Pool.Full:
+            pass
+        # add what fits and put the rest back in front of its racks
+        for i, task in enumerate(ready):
+            try:
+                self.pool.add(task)
+            except Pool.Full:
+                self.requeue(ready[i:])
+                break
+
+    def requeue(self, tasks):
+        with self.cond:
+            for task in reversed(tasks):
+                rack = self.racks[task]
+                self.pending[rack].appendleft(task)
+                self.running[rack] -= 1
+                self.nrunning -= 1
+            self.starved = True
+
+    def on_finished(self, task):
+        with self.cond:
+            rack = self.racks.get(task)
+            if rack is None:
+                # a task of another producer may have left room in the queue
+                if not self.starved:
+                    return
+            else:
+                self.running[rack] -= 1
+                self.nrunning -= 1
+                self.nleft -= 1
+                if self.nleft == 0:
+                    self.cond.notify_all()
+        self.release()
+
+    def wait(self, timeout=None):
+        """Wait until all the commands are finished or timeout.
+
+        On a timeout the commands not started yet are dropped, the running
+        ones are left to the pool.
+        """
+        ts = time.time()
+        try:
+            while True:
+                with self.cond:
+                    if self.nleft == 0:
+                        break
+                    left = 1.0
+                    if timeout is not None:
+                        left = min(left, ts + timeout - time.time())
+                        if left <= 0:
+                            break
+                    self.cond.wait(left)
+                    starved = self.starved
+                if starved:
+                    self.release()
+            with self.cond:
+                done = (self.nleft == 0)
+                if not done:
+                    for pending in self.pending.itervalues():
+                        self.nleft -= len(pending)
+                        pending.clear()
+        finally:
+            self.pool.remove_listener(self)
+        return done
@@ -59,6 +59,134 @@ class RollingStats(object):
         self.meanx2 = 0.0
 
 
+class RollingHist(RollingStats):
+    """Rolling statistics with a log scale histogram in constant memory.
+
+    Values are counted in buckets whose bounds grow geometrically from lo to
+    hi, nbuckets per decade, with one underflow and one overflow bucket.
+    Percentiles are accurate to a bucket width.
+    """
+    def __init__(self, lo=1e-6, hi=1e4, nbuckets=10):
+        super(RollingHist, self).__init__()
+        self.lo = float(lo)
+        self.hi = float(hi)
+        self.nbuckets = nbuckets
+        self.size = int(math.ceil(math.log10(self.hi / self.lo) * nbuckets))
+        self.counts = [0] * (self.size + 2)
+        self.maxx = None
+        self.minx = None
+
+    def update(self, value):
+        super(RollingHist, self).update(value)
+        self.counts[self.bucket(value)] += 1
+        if (self.maxx is None) or (value > self.maxx):
+            self.maxx = value
+        if (self.minx is None) or (value < self.minx):
+            self.minx = value
+
+    def bucket(self, value):
+        if value < self.lo:
+            return 0
+        if value >= self.hi:
+            return self.size + 1
+        return int(math.log10(value / self.lo) * self.nbuckets) + 1
+
+    def bound(self, index):
+        """The upper bound of the bucket at index."""
+        if index > self.size:
+            return self.maxx
+        return self.lo * 10 ** (float(index) / self.nbuckets)
+
+    def percentile(self, q):
+        """The value below which q (0 to 1) of the values fall, within the
+        observed min and max."""
+        if self.n == 0:
+            return None
+        if q <= 0:
+            return self.minx
+        rank = q * self.n
+        count = 0
+        for index, c in enumerate(self.counts):
+            count += c
+            if (count >= rank) and (c != 0):
+                return max(min(self.bound(index), self.maxx), self.minx)
+        return self.maxx
+
+    def clear(self):
+        super(RollingHist, self).clear()
+        self.counts = [0] * (self.size + 2)
+        self.maxx = None
+        self.minx = None
+
+
+class WeightTree(object):
+    """A Fenwick tree of weights for weighted picks in O(log n).
+
+    Changes made after begin() are undone by rollback(), by saving the
+    tree cells they touch, so that a shared tree is restored exactly.
+    """
+    def __init__(self, weights):
+        self.n = len(weights)
+        self.tree = [0.0] * (self.n + 1)
+        for i, weight in enumerate(weights):
+            self.tree[i + 1] += weight
+            j = (i + 1) + ((i + 1) & -(i + 1))
+            if j <= self.n:
+                self.tree[j] += self.tree[i + 1]
+        self.saved = None
+
+    def add(self, index, delta):
+        tree = self.tree
+        saved = self.saved
+        i = index + 1
+        while i <= self.n:
+            if (saved is not None) and (i not in saved):
+                saved[i] = tree[i]
+            tree[i] += delta
+            i += i & -i
+
+    def prefix(self, index):
+        """Sum of the weights before index."""
+        total = 0.0
+        tree = self.tree
+        while index > 0:
+            total += tree[index]
+            index -= index & -index
+        return total
+
+    def range(self, lo, hi):
+        return self.prefix(hi) - self.prefix(lo)
+
+    def find(self, value):
+        """The smallest index whose prefix sum with it exceeds value."""
+        pos = 0
+        bit = 1
+        while bit * 2 <= self.n:
+            bit *= 2
+        tree = self.tree
+        while bit != 0:
+            nxt = pos + bit
+            if (nxt <= self.n) and (tree[nxt] <= value):
+                pos = nxt
+                value -= tree[nxt]
+            bit /= 2
+        return pos
+
+    def pick(self, lo, hi, rand=random.random):
+        """A random index in [lo, hi) with probability by weight."""
+        base = self.prefix(lo)
+        return min(max(self.find(base + rand() * (self.prefix(hi) - base)),
+                       lo), hi - 1)
+
+    def begin(self):
+        self.saved = {}
+
+    def rollback(self):
+        for i, value in self.saved.iteritems():
+            self.tree[i] = value
+        self.saved = None
+
+
 class RandVar(object):
     class Exponential(RollingStats):
         def __init__(self, lambd, lb=-sys.maxint, ub=sys.maxint):